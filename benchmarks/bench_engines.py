@@ -0,0 +1,241 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from origin import add_origin_arguments
+
+# metrics where a larger number is better; the rest are costs
+HIGHER_IS_BETTER = {'throughput_mbps'}
+COMPARED = ('throughput_mbps', 'wall_s', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+
+
+class TimedFetcher:
+    # wraps an engine and records how long every fetch took from submit to
+    # completion, including the losing copies of hedged fetches
+    def __init__(self, engine):
+        self.engine = engine
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def submit(self, i, url, byterange=None, shaper=None):
+        start = time.perf_counter()
+        future = self.engine.submit(i, url, byterange, shaper=shaper)
+        future.add_done_callback(lambda f: self._done(f, start))
+        return future
+
+    def _done(self, future, start):
+        if future.cancelled():
+            return
+        with self.lock:
+            if future.result()[2]:
+                self.errors += 1
+            else:
+                self.latencies.append(time.perf_counter() - start)
+
+    def close(self):
+        self.engine.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def fetch_playlist(origin_url, quality):
+    # the same path a captured title takes: master playlist, variant choice,
+    # then the media playlist saved with absolute URIs
+    import requests
+    import main as moviecli
+    
+    response = requests.get(origin_url + '/master.m3u8', timeout=10)
+    master = moviecli.HLSPlaylist.parse(response.text, response.url)
+    variant = moviecli.select_variant(master.variants, quality)
+    response = requests.get(variant['uri'], timeout=10)
+    return moviecli.absolutize_playlist(response.text, response.url)
+
+
+def run_case(origin_url, engine, workers, quality='highest', adaptive=False):
+    import main as moviecli
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        playlist = os.path.join(tmp, 'index.m3u8')
+        with open(playlist, 'w') as f:
+            f.write(fetch_playlist(origin_url, quality))
+        
+        output = os.path.join(tmp, 'out.ts')
+        fetcher = TimedFetcher(moviecli.create_engine(engine, workers, adaptive))
+        start = time.time()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                ok = moviecli.download_m3u8_video(playlist, output, workers, settings={'engine': engine, 'adaptive': adaptive}, fetcher=fetcher)
+        finally:
+            fetcher.close()
+        wall = time.time() - start
+        size = os.path.getsize(output) if os.path.exists(output) else 0
+    
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    
+    p50, p99 = percentile(fetcher.latencies, 0.5), percentile(fetcher.latencies, 0.99)
+    return {
+        'engine': engine,
+        'workers': workers,
+        'adaptive': adaptive,
+        'ok': ok,
+        'bytes': size,
+        'requests': len(fetcher.latencies) + fetcher.errors,
+        'errors': fetcher.errors,
+        'wall_s': round(wall, 3),
+        'throughput_mbps': round(size * 8 / wall / 1_000_000, 2),
+        'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 1) if p99 is not None else None,
+        'peak_rss_mb': round(rss / (1024 * 1024), 1),
+    }
+
+
+def case_key(result):
+    return f"{result['engine']}/{result['workers']}{'/adaptive' if result.get('adaptive') else ''}"
+
+
+def compare(results, baseline, tolerance):
+    # a metric regresses when it is worse than the baseline run by more than
+    # tolerance (a fraction); returns the regressions found
+    previous = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if not before:
+            continue
+        changes = []
+        for metric in COMPARED:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            changes.append(f"{metric} {change * 100:+.1f}%")
+            if worse > tolerance:
+                regressions.append(f"{case_key(result)} {metric}: {old} -> {new}")
+        print(f"{case_key(result):>20} vs baseline: {', '.join(changes)}", file=sys.stderr)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the segment engines against a local stand-in HLS origin')
+    add_origin_arguments(parser)
+    parser.set_defaults(segments=400, segment_size=188 * 2000, latency=0.1, stall=5.0)
+    parser.add_argument('--engines', default='thread,async')
+    parser.add_argument('--workers', default='20,100,300')
+    parser.add_argument('--adaptive', action='store_true', help='let the concurrency controller tune each case, with --workers as the ceiling')
+    parser.add_argument('--quality', default='highest', help='rendition picked from the master playlist')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case; the median by wall time is kept')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed slowdown against --baseline before the run fails')
+    parser.add_argument('--case', nargs=5, metavar=('URL', 'ENGINE', 'WORKERS', 'QUALITY', 'ADAPTIVE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.case:
+        url, engine, workers, quality, adaptive = args.case
+        print(json.dumps(run_case(url, engine, int(workers), quality, adaptive == '1')))
+        return
+    
+    origin_args = [
+        '--port', '0', '--segments', str(args.segments), '--segment-size', str(args.segment_size),
+        '--latency', str(args.latency), '--variants', args.variants,
+        '--bandwidth', str(args.bandwidth), '--connection-bandwidth', str(args.connection_bandwidth),
+        '--fail-rate', str(args.fail_rate), '--throttle-rate', str(args.throttle_rate), '--corrupt-rate', str(args.corrupt_rate),
+        '--stall-rate', str(args.stall_rate), '--hang-rate', str(args.hang_rate), '--stall', str(args.stall),
+    ] + (['--byterange'] if args.byterange else []) + (['--encrypt'] if args.encrypt else [])
+    
+    # the origin and every case run in separate processes so one engine's
+    # threads and buffers never show up in another's RSS or CPU time
+    origin = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'origin.py')] + origin_args,
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        url = origin.stdout.readline().split()[-1].rsplit('/', 1)[0]
+        results = []
+        for engine in args.engines.split(','):
+            for workers in args.workers.split(','):
+                runs = []
+                for _ in range(args.repeat):
+                    out = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), '--case', url, engine, workers, args.quality, '1' if args.adaptive else '0'],
+                        capture_output=True, text=True
+                    )
+                    if out.returncode != 0:
+                        print(out.stderr, file=sys.stderr)
+                        continue
+                    runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+                if not runs:
+                    continue
+                result = sorted(runs, key=lambda run: run['wall_s'])[len(runs) // 2]
+                results.append(result)
+                print(f"{engine:>6} x{int(workers):<4} {result['throughput_mbps']:>9.2f} Mbps "
+                      f"{result['wall_s']:>7.2f}s p50 {result['p50_ms']} ms p99 {result['p99_ms']} ms "
+                      f"{result['peak_rss_mb']:>7.1f} MB RSS{'' if result['ok'] else ' INCOMPLETE'}", file=sys.stderr)
+    finally:
+        origin.terminate()
+        origin.wait()
+    
+    report = {
+        'revision': git_revision(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: value for name, value in vars(args).items()
+                   if name not in ('engines', 'workers', 'output', 'baseline', 'tolerance', 'case', 'repeat')},
+        'results': results,
+    }
+    
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != report['settings']:
+            print("warning: the baseline was run with different settings", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        report['regressions'] = regressions
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
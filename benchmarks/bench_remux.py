@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+VIDEO_PID = 0x100
+AUDIO_PID = 0x101
+PMT_PID = 0x1000
+
+
+class BitWriter:
+    def __init__(self):
+        self.bits = []
+
+    def write(self, value, count):
+        self.bits.extend((value >> (count - 1 - i)) & 1 for i in range(count))
+
+    def ue(self, value):
+        value += 1
+        self.write(0, value.bit_length() - 1)
+        self.write(value, value.bit_length())
+
+    def bytes(self):
+        self.bits.append(1)
+        while len(self.bits) % 8:
+            self.bits.append(0)
+        return bytes(int(''.join(map(str, self.bits[i:i + 8])), 2) for i in range(0, len(self.bits), 8))
+
+
+def make_sps(width, height):
+    bits = BitWriter()
+    bits.write(66, 8)
+    bits.write(0, 8)
+    bits.write(31, 8)
+    bits.ue(0)
+    bits.ue(0)
+    bits.ue(2)
+    bits.ue(1)
+    bits.write(0, 1)
+    bits.ue(width // 16 - 1)
+    bits.ue(height // 16 - 1)
+    bits.write(1, 1)
+    bits.write(1, 1)
+    bits.write(0, 1)
+    bits.write(0, 1)
+    return b'\x67' + bits.bytes()
+
+
+def crc32_mpeg(data):
+    crc = 0xffffffff
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else crc << 1
+            crc &= 0xffffffff
+    return crc
+
+
+def section(table_id, body):
+    header = bytes([table_id, 0xb0 | ((len(body) + 9) >> 8), (len(body) + 9) & 0xff, 0, 1, 0xc1, 0, 0])
+    data = header + body
+    return b'\x00' + data + crc32_mpeg(data).to_bytes(4, 'big')
+
+
+def packets(pid, payload, counters, unit_start=True):
+    out = bytearray()
+    first = True
+    while payload:
+        header = bytes([0x47, (0x40 if first and unit_start else 0) | (pid >> 8), pid & 0xff])
+        counter = counters.get(pid, 0)
+        counters[pid] = (counter + 1) % 16
+        if len(payload) >= 184:
+            out += header + bytes([0x10 | counter]) + payload[:184]
+            payload = payload[184:]
+        else:
+            stuffing = 184 - len(payload) - 1
+            adaptation = bytes([stuffing]) + (bytes([0]) + b'\xff' * (stuffing - 1) if stuffing else b'')
+            out += header + bytes([0x30 | counter]) + adaptation + payload
+            payload = b''
+        first = False
+    return bytes(out)
+
+
+def timestamp(marker, value):
+    return bytes([
+        (marker << 4) | (((value >> 30) & 0x07) << 1) | 1,
+        (value >> 22) & 0xff, (((value >> 15) & 0x7f) << 1) | 1,
+        (value >> 7) & 0xff, ((value & 0x7f) << 1) | 1,
+    ])
+
+
+def pes(stream_id, data, pts, dts=None):
+    if dts is None:
+        header = bytes([0x80, 0x80, 5]) + timestamp(2, pts)
+    else:
+        header = bytes([0x80, 0xc0, 10]) + timestamp(3, pts) + timestamp(1, dts)
+    length = len(header) + len(data)
+    return b'\x00\x00\x01' + bytes([stream_id]) + (length.to_bytes(2, 'big') if length < 65536 else b'\x00\x00') + header + data
+
+
+def make_ts(seconds, bitrate, seed=1):
+    # a synthetic H.264 + AAC transport stream: real parameter sets and
+    # stream structure, random slice and audio payloads
+    rng = random.Random(seed)
+    counters = {}
+    pat = packets(0, section(0x00, bytes([0, 1, 0xe0 | (PMT_PID >> 8), PMT_PID & 0xff])), counters)
+    pmt_body = bytes([0xe0 | (VIDEO_PID >> 8), VIDEO_PID & 0xff, 0xf0, 0])
+    pmt_body += bytes([0x1b, 0xe0 | (VIDEO_PID >> 8), VIDEO_PID & 0xff, 0xf0, 0])
+    pmt_body += bytes([0x0f, 0xe0 | (AUDIO_PID >> 8), AUDIO_PID & 0xff, 0xf0, 0])
+    pmt = packets(PMT_PID, section(0x02, pmt_body), counters)
+
+    sps = make_sps(1280, 720)
+    pps = b'\x68\xce\x38\x80'
+    frame_bytes = bitrate // 8 // 25
+    out = bytearray()
+    audio_pts = 0
+    for frame in range(seconds * 25):
+        if frame % 50 == 0:
+            out += pat + pmt
+        dts = 126000 + frame * 3600
+        key = frame % 50 == 0
+        units = [b'\x09\xf0']
+        if key:
+            units += [sps, pps]
+        body = rng.randbytes(frame_bytes * (4 if key else 1)).replace(b'\x00\x00', b'\x00\x01')
+        units.append((b'\x65' if key else b'\x41') + body)
+        access_unit = b''.join(b'\x00\x00\x00\x01' + unit for unit in units)
+        out += packets(VIDEO_PID, pes(0xe0, access_unit, dts + 3600, dts), counters)
+
+        while audio_pts <= dts:
+            frames = b''
+            for _ in range(4):
+                payload = rng.randbytes(300)
+                length = len(payload) + 7
+                frames += bytes([0xff, 0xf1, 0x50, 0x80 | (length >> 11), (length >> 3) & 0xff, ((length & 7) << 5) | 0x1f, 0xfc]) + payload
+            out += packets(AUDIO_PID, pes(0xc0, frames, 126000 + audio_pts), counters)
+            audio_pts += 4 * 1024 * 90000 // 44100
+    return bytes(out)
+
+
+def main():
+    import main as moviecli
+
+    parser = argparse.ArgumentParser(description='Measure TS-to-MP4 remux throughput on a synthetic stream')
+    parser.add_argument('--seconds', type=int, default=120)
+    parser.add_argument('--bitrate', type=int, default=8_000_000, help='video bits per second')
+    parser.add_argument('--segment-size', type=int, default=188 * 5000, help='bytes handed to the remuxer per write')
+    args = parser.parse_args()
+
+    data = make_ts(args.seconds, args.bitrate)
+    with tempfile.TemporaryDirectory() as tmp:
+        # baseline: the bytes written to the .ts with no remuxing at all
+        start = time.perf_counter()
+        with open(os.path.join(tmp, 'copy.ts'), 'wb') as f:
+            for offset in range(0, len(data), args.segment_size):
+                f.write(data[offset:offset + args.segment_size])
+        copy_s = time.perf_counter() - start
+
+        path = os.path.join(tmp, 'out.mp4')
+        start = time.perf_counter()
+        remuxer = moviecli.TSRemuxer(path)
+        for offset in range(0, len(data), args.segment_size):
+            remuxer.write(data[offset:offset + args.segment_size])
+        ok = remuxer.close()
+        remux_s = time.perf_counter() - start
+        mp4_size = os.path.getsize(path) if ok else 0
+
+    result = {
+        'ok': ok,
+        'error': str(remuxer.error) if remuxer.error else None,
+        'ts_bytes': len(data),
+        'mp4_bytes': mp4_size,
+        'copy_mbps': round(len(data) / copy_s / 1_000_000, 1),
+        'remux_mbps': round(len(data) / remux_s / 1_000_000, 1),
+        'realtime_factor': round(args.seconds / remux_s, 1),
+    }
+    print(f"{len(data) / 1_000_000:.1f} MB TS -> {mp4_size / 1_000_000:.1f} MB MP4, "
+          f"remux {result['remux_mbps']} MB/s ({result['realtime_factor']}x realtime), copy {result['copy_mbps']} MB/s",
+          file=sys.stderr)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
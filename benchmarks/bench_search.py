@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def time_parse(parse, page, iterations):
+    # best of three runs so a stray GC pause or scheduler hiccup does not
+    # decide the comparison
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            results = parse(page, 8)
+        elapsed = (time.perf_counter() - start) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    import main as moviecli
+
+    parser = argparse.ArgumentParser(description='Compare the regex and BeautifulSoup search result parsers on saved pages')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--parsers', default='bs4,regex')
+    args = parser.parse_args()
+
+    pages = {
+        'duckduckgo': ('duckduckgo.html', '_parse_duckduckgo'),
+        'tmdb': ('tmdb_search.html', '_parse_direct'),
+    }
+
+    results = []
+    for name, (fixture, method) in pages.items():
+        with open(os.path.join(FIXTURES, fixture), 'r', encoding='utf-8') as f:
+            page = f.read()
+
+        parsed = {}
+        for backend in args.parsers.split(','):
+            searcher = moviecli.TMDBSearcher(parser=backend)
+            seconds, parsed[backend] = time_parse(getattr(searcher, method), page, args.iterations)
+            results.append({
+                'page': name,
+                'parser': backend,
+                'results': len(parsed[backend]),
+                'ms_per_parse': round(seconds * 1000, 3),
+            })
+            print(f"{name:>10} {backend:>5} {seconds * 1000:>8.3f} ms {len(parsed[backend]):>3} results", file=sys.stderr)
+
+        if len({json.dumps(r, sort_keys=True) for r in parsed.values()}) > 1:
+            print(f"warning: parsers disagree on {name}", file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
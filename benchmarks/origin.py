@@ -0,0 +1,294 @@
+import argparse
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VARIANT_RE = re.compile(r'/(\d+)p(/.*)$')
+
+
+def make_segment(index, size):
+    packet = bytearray(188)
+    packet[0] = 0x47
+    packet[1] = index % 256
+    return bytes(packet) * (size // 188)
+
+
+def encrypt_segment(body, key, index):
+    # AES-128-CBC with PKCS7 padding and the media sequence number as the IV,
+    # as an EXT-X-KEY without an IV attribute asks for
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    padding = 16 - len(body) % 16
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(index.to_bytes(16, 'big'))).encryptor()
+    return encryptor.update(body + bytes([padding]) * padding) + encryptor.finalize()
+
+
+class Pacer:
+    # paces writes to a byte rate; shared by every connection when it caps the
+    # origin as a whole, one per response when it caps a single connection
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def take(self, size):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_free)
+            self.next_free = start + size / self.rate
+            delay = self.next_free - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        path = self.path.split('?')[0]
+        
+        if path == '/master.m3u8':
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+            for height in config['variants']:
+                width = height * 16 // 9
+                bandwidth = self.server.variant_size(height) * 8 // config['duration']
+                lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},CODECS="avc1.64001f,mp4a.40.2"')
+                lines.append(f"{height}p/index.m3u8")
+            self._send(('\n'.join(lines) + '\n').encode('utf-8'), 'application/vnd.apple.mpegurl')
+            return
+        
+        # /720p/... is that rendition; unprefixed paths are the top one
+        height = config['variants'][0]
+        match = VARIANT_RE.match(path)
+        if match and int(match.group(1)) in config['variants']:
+            height, path = int(match.group(1)), match.group(2)
+        size = self.server.variant_size(height)
+        
+        if path.endswith('.m3u8'):
+            lines = ['#EXTM3U', '#EXT-X-VERSION:4' if config['byterange'] else '#EXT-X-VERSION:3', f"#EXT-X-TARGETDURATION:{config['duration']}"]
+            if config['encrypt']:
+                lines.append('#EXT-X-KEY:METHOD=AES-128,URI="/key.bin"')
+            for i in range(config['segments']):
+                lines.append(f"#EXTINF:{config['duration']:.1f},")
+                if config['byterange']:
+                    # every segment is a slice of one resource, written with a
+                    # relative URI so clients have to resolve it
+                    lines.append(f"#EXT-X-BYTERANGE:{size}@{i * size}")
+                    lines.append('media.ts')
+                else:
+                    lines.append(f"seg/{i}.ts")
+            lines.append('#EXT-X-ENDLIST')
+            self._send(('\n'.join(lines) + '\n').encode('utf-8'), 'application/vnd.apple.mpegurl')
+            return
+        
+        if path == '/key.bin' and config['encrypt']:
+            self._send(self.server.key, 'application/octet-stream')
+            return
+        
+        if path != '/media.ts' and not path.startswith('/seg/'):
+            self.send_error(404)
+            return
+        
+        roll = random.random()
+        if roll < config['fail_rate']:
+            self.send_error(random.choice((500, 502, 503, 504)))
+            return
+        roll -= config['fail_rate']
+        if roll < config['throttle_rate']:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        roll -= config['throttle_rate']
+        if roll < config['corrupt_rate']:
+            # a 200 that is not the segment: an error page, or packets that
+            # lost their sync bytes
+            body = b'<html><body>502 Bad Gateway</body></html>' if random.random() < 0.5 else bytes(size)
+            self._send(body, 'text/html' if body.startswith(b'<') else 'video/mp2t')
+            return
+        roll -= config['corrupt_rate']
+        if roll < config['stall_rate']:
+            time.sleep(config['stall'])
+        hang = random.random() < config['hang_rate']
+        
+        if config['latency']:
+            time.sleep(config['latency'])
+        
+        if path == '/media.ts':
+            self._send_range(config, height, size, hang)
+        else:
+            index = int(path.rsplit('/', 1)[1].split('.')[0])
+            body = self.server.segment_body(index, size)
+            match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(len(body) - 1, int(match.group(2))) if match.group(2) else len(body) - 1
+                self._send(body[start:end + 1], 'video/mp2t', 206, {'Content-Range': f"bytes {start}-{end}/{len(body)}"}, hang)
+            else:
+                self._send(body, 'video/mp2t', hang=hang)
+
+    def _send_range(self, config, height, size, hang=False):
+        total = size * config['segments']
+        start, end = 0, total - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(total - 1, int(match.group(2))) if match.group(2) else total - 1
+        
+        # segment bodies are whole multiples of 188-byte packets, so a slice can
+        # be assembled from the cached per-segment bodies
+        body = bytearray()
+        first, last = start // size, end // size
+        for index in range(first, last + 1):
+            body += self.server.segment_body(index, size)
+        body = bytes(body[start - first * size:end - first * size + 1])
+        
+        headers = {'Content-Range': f"bytes {start}-{end}/{total}"} if match else {}
+        self._send(body, 'video/mp2t', 206 if match else 200, headers, hang)
+
+    def _send(self, body, content_type, status=200, headers=None, hang=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.server.requests += 1
+        
+        if hang:
+            # half the body, then the connection goes quiet and is dropped
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            time.sleep(self.server.config['stall'])
+            self.close_connection = True
+            return
+        
+        connection = Pacer(self.server.config['connection_bandwidth']) if self.server.config['connection_bandwidth'] else None
+        if not connection and not self.server.pacer:
+            self.wfile.write(body)
+            return
+        for offset in range(0, len(body), 64 * 1024):
+            chunk = body[offset:offset + 64 * 1024]
+            if self.server.pacer:
+                self.server.pacer.take(len(chunk))
+            if connection:
+                connection.take(len(chunk))
+            self.wfile.write(chunk)
+
+
+class HLSOrigin(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, segments=200, segment_size=188 * 5000, duration=4, latency=0.0, byterange=False,
+                 fail_rate=0.0, stall_rate=0.0, stall=10.0, throttle_rate=0.0, hang_rate=0.0, bandwidth=None,
+                 connection_bandwidth=None, variants=(1080,), corrupt_rate=0.0, encrypt=False):
+        super().__init__((host, port), OriginHandler)
+        self.config = {
+            'segments': segments,
+            'segment_size': segment_size,
+            'duration': duration,
+            'latency': latency,
+            'byterange': byterange,
+            'fail_rate': fail_rate,
+            'stall_rate': stall_rate,
+            'stall': stall,
+            'throttle_rate': throttle_rate,
+            'hang_rate': hang_rate,
+            'corrupt_rate': corrupt_rate,
+            # bytes per second; None is unlimited
+            'bandwidth': bandwidth,
+            'connection_bandwidth': connection_bandwidth,
+            'variants': sorted(variants, reverse=True),
+            # AES-128 segments; byte ranges would need the padded sizes, so
+            # encryption is for whole-file segments only
+            'encrypt': encrypt and not byterange,
+        }
+        self.key = os.urandom(16)
+        self.pacer = Pacer(bandwidth) if bandwidth else None
+        self._bodies = {}
+        self.requests = 0
+
+    def handle_error(self, request, client_address):
+        # clients hang up mid-response on purpose (probes, cancelled hedges)
+        pass
+
+    def variant_size(self, height):
+        # lower renditions get proportionally smaller segments, whole packets
+        top = self.config['variants'][0]
+        return max(188, self.config['segment_size'] * height * height // (top * top) // 188 * 188)
+
+    def segment_body(self, index, size=None):
+        size = size or self.variant_size(self.config['variants'][0])
+        # encrypted bodies differ by the full index, not just its low byte
+        cache_key = (size, index if self.config['encrypt'] else index % 256)
+        body = self._bodies.get(cache_key)
+        if body is None:
+            body = make_segment(index, size)
+            if self.config['encrypt']:
+                body = encrypt_segment(body, self.key, index)
+            self._bodies[cache_key] = body
+        return body
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def add_origin_arguments(parser):
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--segment-size', type=int, default=188 * 5000, help='bytes per segment of the top rendition')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every segment response')
+    parser.add_argument('--byterange', action='store_true', help='serve segments as EXT-X-BYTERANGE slices of one resource')
+    parser.add_argument('--variants', default='1080', help='comma-separated rendition heights listed in /master.m3u8')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='cap on the whole origin in Mbps (0 is unlimited)')
+    parser.add_argument('--connection-bandwidth', type=float, default=0.0, help='cap per response in Mbps (0 is unlimited)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of segment requests answered with a 5xx')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of segment requests answered with 429')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='fraction of segment requests answered 200 with something that is not the segment')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of segment requests held back by --stall seconds')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of segment responses that stop halfway for --stall seconds and drop')
+    parser.add_argument('--stall', type=float, default=10.0)
+    parser.add_argument('--encrypt', action='store_true', help='encrypt segments with AES-128 (EXT-X-KEY, needs cryptography); ignored with --byterange')
+
+
+def origin_from_arguments(args, port=0):
+    return HLSOrigin(
+        port=port, segments=args.segments, segment_size=args.segment_size, latency=args.latency,
+        byterange=args.byterange, fail_rate=args.fail_rate, stall_rate=args.stall_rate, stall=args.stall,
+        throttle_rate=args.throttle_rate, hang_rate=args.hang_rate, corrupt_rate=args.corrupt_rate,
+        bandwidth=args.bandwidth * 1_000_000 / 8 or None,
+        connection_bandwidth=args.connection_bandwidth * 1_000_000 / 8 or None,
+        variants=[int(height) for height in args.variants.split(',')],
+        encrypt=args.encrypt,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in HLS origin serving a synthetic playlist')
+    parser.add_argument('--port', type=int, default=8765)
+    add_origin_arguments(parser)
+    args = parser.parse_args()
+    
+    origin = origin_from_arguments(args, args.port)
+    print(f"Serving {origin.url}/master.m3u8", flush=True)
+    try:
+        origin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
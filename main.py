@@ -1,137 +1,531 @@
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import os
 import sys
 import re
-from urllib.parse import quote
+import hashlib
+import asyncio
+import threading
+import heapq
+import bisect
+import random
+import queue
+import shlex
+import itertools
+import collections
+import contextlib
+import struct
+import html
+from urllib.parse import quote, unquote, urljoin, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 
-class TMDBSearcher:
+class DiskCache:
+    # small JSON-backed map for lookups that are slow to redo (searches,
+    # browser captures); entries expire after ttl seconds and the least
+    # recently used go once max_entries is hit. Several runs can share one
+    # file: writes merge with what is on disk under a lock file, and hits
+    # only touch memory until the next write
+    def __init__(self, path, ttl=6 * 3600, max_entries=200, lock_timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock_timeout = lock_timeout
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        # keys this process dropped, with when, so a merge does not bring
+        # them back from disk
+        self.removed = {}
+
+    def _load(self):
+        import json
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # O_EXCL creation works the same everywhere; a lock left behind by a
+        # run that died is taken over once it is older than the timeout
+        lock_path = self.path + '.lock'
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(lock_path) > self.lock_timeout
+                except OSError:
+                    stale = False
+                if stale or time.time() > deadline:
+                    with contextlib.suppress(OSError):
+                        os.remove(lock_path)
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(lock_path)
+
+    def _save(self):
+        import json
+        directory = os.path.dirname(self.path)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._file_lock():
+                # another run may have written since this one loaded: newer
+                # values win, last use is the latest either side saw
+                merged = self._load()
+                for k, removed in self.removed.items():
+                    if k in merged and merged[k].get('stored', 0) <= removed:
+                        del merged[k]
+                for k, entry in self.entries.items():
+                    other = merged.get(k)
+                    if isinstance(other, dict) and other.get('stored', 0) > entry['stored']:
+                        other['used'] = max(other.get('used', 0), entry['used'])
+                    else:
+                        merged[k] = dict(entry, used=max(entry['used'], other.get('used', 0) if isinstance(other, dict) else 0))
+                
+                now = time.time()
+                merged = {k: e for k, e in merged.items() if isinstance(e, dict) and 'value' in e and now - e.get('stored', 0) <= self.ttl}
+                while len(merged) > self.max_entries:
+                    del merged[min(merged, key=lambda k: merged[k].get('used', 0))]
+                
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(merged, f)
+                os.replace(tmp_path, self.path)
+            self.entries = merged
+            self.removed = {}
+        except OSError as e:
+            print(f"Could not write cache: {e}")
+
+    @staticmethod
+    def _key(key):
+        return '/'.join('' if part is None else str(part) for part in key)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(self._key(key))
+            if not isinstance(entry, dict) or 'value' not in entry:
+                return None
+            now = time.time()
+            if now - entry['stored'] > self.ttl:
+                del self.entries[self._key(key)]
+                return None
+            # saved with the next put or discard
+            entry['used'] = now
+            return entry['value']
+
+    def put(self, key, value):
+        with self.lock:
+            now = time.time()
+            self.entries[self._key(key)] = {'value': value, 'stored': now, 'used': now}
+            self.removed.pop(self._key(key), None)
+            self._save()
+
+    def discard(self, key):
+        with self.lock:
+            if self.entries.pop(self._key(key), None) is not None:
+                self.removed[self._key(key)] = time.time()
+                self._save()
+
+
+def default_cache_path(name):
+    return os.path.join(os.path.expanduser('~'), '.moviecli', name)
+
+
+class Metrics:
+    # process-wide counters, latency histograms and per-host totals for every
+    # stage of the pipeline, plus the spans behind a Chrome trace; every
+    # update is O(1) so it stays on for whole runs and a daemon can report it
+    # live. Histograms bucket by powers of two in milliseconds: bucket k
+    # holds durations under 2**k ms
+    BUCKETS = 24
+    # spans kept for the trace: the most recent ones, so a long daemon run
+    # stays bounded and its trace still shows the latest jobs; older spans
+    # are counted as they fall out
+    MAX_SPANS = 20_000
+
     def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.hosts = {}
+        self.spans = collections.deque(maxlen=self.MAX_SPANS)
+        self.span_ids = itertools.count(1)
+        self.threads = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        bucket = min(self.BUCKETS - 1, int(seconds * 1000).bit_length())
+        with self.lock:
+            self._observe(name, seconds, bucket)
+
+    def _observe(self, name, seconds, bucket):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * self.BUCKETS}
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        histogram['buckets'][bucket] += 1
+
+    def _span(self, span):
+        if len(self.spans) == self.MAX_SPANS:
+            self.counters['trace_spans_dropped'] += 1
+        self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # times a stage on the calling thread; nested stages nest in the trace
+        start = time.time()
+        try:
+            yield args
+        finally:
+            seconds = time.time() - start
+            bucket = min(self.BUCKETS - 1, int(seconds * 1000).bit_length())
+            with self.lock:
+                self._observe(name, seconds, bucket)
+                self.threads[threading.get_ident()] = threading.current_thread().name
+                self._span((name, start, seconds, threading.get_ident(), args))
+
+    def fetch(self, host, start, nbytes, error=None, hedge=False):
+        # one finished segment request, whichever engine ran it; fetches
+        # overlap, so they go into the trace as async spans rather than on a
+        # thread
+        seconds = time.time() - start
+        bucket = min(self.BUCKETS - 1, int(seconds * 1000).bit_length())
+        with self.lock:
+            self._observe('fetch', seconds, bucket)
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = self.hosts[host] = {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0}
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            if error:
+                stats['errors'] += 1
+            else:
+                stats['bytes'] += nbytes
+            args = {'host': host, 'bytes': nbytes}
+            if error:
+                args['error'] = str(error)
+            if hedge:
+                args['hedge'] = True
+            self._span(('fetch', start, seconds, None, args))
+
+    @staticmethod
+    def _quantile(histogram, fraction):
+        # interpolated within the bucket the quantile falls in
+        rank = fraction * histogram['count']
+        seen = 0
+        for bucket, count in enumerate(histogram['buckets']):
+            if count and seen + count >= rank:
+                low = 2 ** (bucket - 1) if bucket else 0
+                return min(low + (2 ** bucket - low) * (rank - seen) / count, histogram['max'] * 1000)
+            seen += count
+        return histogram['max'] * 1000
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime_s': round(time.time() - self.origin, 3),
+                'counters': dict(self.counters),
+                'latency_ms': {
+                    name: {
+                        'count': histogram['count'],
+                        'mean': round(histogram['sum'] * 1000 / histogram['count'], 3),
+                        'p50': round(self._quantile(histogram, 0.5), 3),
+                        'p90': round(self._quantile(histogram, 0.9), 3),
+                        'p99': round(self._quantile(histogram, 0.99), 3),
+                        'max': round(histogram['max'] * 1000, 3),
+                        'total_s': round(histogram['sum'], 3),
+                        # upper bound in ms -> count, empty buckets left out
+                        'buckets': {2 ** bucket: count for bucket, count in enumerate(histogram['buckets']) if count},
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+                'hosts': {
+                    # seconds add up every request, so overlapping ones count
+                    # twice and the rate is per connection
+                    host: dict(stats, seconds=round(stats['seconds'], 3),
+                               connection_mbps=round(stats['bytes'] * 8 / stats['seconds'] / 1_000_000, 2) if stats['seconds'] else 0.0)
+                    for host, stats in self.hosts.items()
+                },
+            }
+
+    def trace(self):
+        # Chrome trace event format, for chrome://tracing or ui.perfetto.dev
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'moviecli'}}]
+        with self.lock:
+            spans = list(self.spans)
+            for thread, name in self.threads.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}})
+        for name, start, seconds, thread, args in spans:
+            ts = round((start - self.origin) * 1_000_000)
+            if thread is not None:
+                events.append({'name': name, 'cat': 'stage', 'ph': 'X', 'ts': ts, 'dur': round(seconds * 1_000_000), 'pid': pid, 'tid': thread, 'args': args})
+            else:
+                span_id = next(self.span_ids)
+                events.append({'name': name, 'cat': 'fetch', 'ph': 'b', 'id': span_id, 'ts': ts, 'pid': pid, 'tid': 0, 'args': args})
+                events.append({'name': name, 'cat': 'fetch', 'ph': 'e', 'id': span_id, 'ts': ts + round(seconds * 1_000_000), 'pid': pid, 'tid': 0})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, metrics_file=None, trace_file=None):
+        import json
+        for path, build in ((metrics_file, self.snapshot), (trace_file, self.trace)):
+            if not path:
+                continue
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(build(), f)
+                print(f"Wrote {path}")
+            except OSError as e:
+                print(f"✗ Could not write {path}: {e}")
+
+
+metrics = Metrics()
+
+
+DDG_LINK_RE = re.compile(r'<a\s([^>]*\bclass="[^"]*\bresult__a\b[^"]*"[^>]*)>(.*?)</a>', re.DOTALL | re.IGNORECASE)
+TMDB_CARD_RE = re.compile(r'<div\s[^>]*\bclass="(?:[^"]*\s)?card(?:\s[^"]*)?"', re.IGNORECASE)
+TMDB_RESULT_LINK_RE = re.compile(r'<a\s[^>]*\bclass="(?:[^"]*\s)?result(?:\s[^"]*)?"[^>]*>', re.IGNORECASE)
+TMDB_REFERENCE_RE = re.compile(r'^(?:tmdb:)?(?:https?://(?:www\.)?themoviedb\.org/)?(movie|tv)[/:](\d+)', re.IGNORECASE)
+
+
+def _attribute(tag, name):
+    match = re.search(rf'\b{name}="([^"]*)"', tag)
+    return html.unescape(match.group(1)) if match else ''
+
+
+def _text(fragment):
+    return html.unescape(re.sub(r'<[^>]+>', '', fragment)).strip()
+
+
+def parse_tmdb_reference(query):
+    # "movie/603", "tv:1396", "tmdb:movie/603" or a themoviedb.org URL
+    match = TMDB_REFERENCE_RE.match(query.strip())
+    if match:
+        return match.group(1).lower(), int(match.group(2))
+    return None
+
+
+class TMDBSearcher:
+    def __init__(self, cache=None, parser='regex'):
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Accept-Language': 'en-US,en;q=0.9',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
         })
+        self.cache = cache
+        # 'regex' pulls the few fields we need straight out of the markup;
+        # 'bs4' builds a full BeautifulSoup tree and is kept as a fallback
+        self.parser = parser
 
     def search(self, query, max_results=8):
+        reference = parse_tmdb_reference(query)
+        if reference:
+            result = self.lookup(*reference)
+            return [result] if result else []
+        
+        key = ('search', query.strip().lower(), max_results)
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached:
+                metrics.count('search_cache_hits')
+                return cached
+        
         try:
             search_query = f"{query} tmdb"
             results = self._search_duckduckgo(search_query, max_results)
             if not results:
                 results = self._search_direct(query, max_results)
-            return results
         except Exception as e:
             print(f"Search error: {e}")
             return []
+        
+        if results and self.cache:
+            self.cache.put(key, results)
+        return results
+
+    def lookup(self, content_type, tmdb_id):
+        # a known id skips the search; the title page is only read for the
+        # name and year used in the output file name
+        key = ('lookup', content_type, tmdb_id)
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached:
+                return cached
+        
+        result = {'type': content_type, 'id': tmdb_id, 'title': f"{content_type}-{tmdb_id}", 'year': '', 'similarity': 1.0, 'popularity': 100}
+        try:
+            response = self.session.get(f"https://www.themoviedb.org/{content_type}/{tmdb_id}", timeout=10)
+            response.raise_for_status()
+            match = re.search(r'<title>(.*?)</title>', response.text, re.DOTALL | re.IGNORECASE)
+            if match:
+                title = re.sub(r'\s*[-—]\s*The Movie Database.*', '', _text(match.group(1)), flags=re.IGNORECASE)
+                year_match = re.search(r'\((\d{4})\)', title)
+                if year_match:
+                    result['year'] = year_match.group(1)
+                    title = re.sub(r'\s*\(\d{4}\)', '', title).strip()
+                if title:
+                    result['title'] = title
+        except Exception as e:
+            print(f"TMDB lookup failed, using {result['title']} as the title: {e}")
+            return result
+        
+        if self.cache:
+            self.cache.put(key, result)
+        return result
+
+    def _duckduckgo_links(self, page):
+        if self.parser == 'bs4':
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(page, 'html.parser')
+            return [(a.get('href', ''), a.get_text(strip=True)) for a in soup.find_all('a', class_='result__a')]
+        return [(_attribute(attrs, 'href'), _text(body)) for attrs, body in DDG_LINK_RE.findall(page)]
+
+    def _tmdb_cards(self, page):
+        if self.parser == 'bs4':
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(page, 'html.parser')
+            cards = []
+            for card in soup.find_all('div', class_='card'):
+                link = card.find('a', class_='result')
+                title_elem = card.find('h2')
+                year_elem = card.find('span', class_='release_date')
+                cards.append((
+                    link.get('href', '') if link else None,
+                    title_elem.get_text(strip=True) if title_elem else None,
+                    year_elem.get_text() if year_elem else ''
+                ))
+            return cards
+        
+        # each card runs until the next one starts, which is close enough to
+        # scope the link, heading and date lookups without a tree
+        cards = []
+        starts = [m.start() for m in TMDB_CARD_RE.finditer(page)] + [len(page)]
+        for start, end in zip(starts, starts[1:]):
+            chunk = page[start:end]
+            link = TMDB_RESULT_LINK_RE.search(chunk)
+            title = re.search(r'<h2[^>]*>(.*?)</h2>', chunk, re.DOTALL | re.IGNORECASE)
+            year = re.search(r'<span\s[^>]*\bclass="(?:[^"]*\s)?release_date(?:\s[^"]*)?"[^>]*>(.*?)</span>', chunk, re.DOTALL | re.IGNORECASE)
+            cards.append((
+                _attribute(link.group(0), 'href') if link else None,
+                _text(title.group(1)) if title else None,
+                _text(year.group(1)) if year else ''
+            ))
+        return cards
 
     def _search_duckduckgo(self, query, max_results):
         try:
             url = f"https://html.duckduckgo.com/html/?q={quote(query)}"
             response = self.session.get(url, timeout=10)
-            from bs4 import BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            results = []
-            for result in soup.find_all('a', class_='result__a'):
-                href = result.get('href', '')
-                if 'uddg=' in href:
-                    actual_url = href.split('uddg=')[1].split('&')[0]
-                    from urllib.parse import unquote
-                    actual_url = unquote(actual_url)
-                else:
-                    actual_url = href
-                
-                tmdb_match = re.search(r'themoviedb\.org/(movie|tv)/(\d+)', actual_url)
-                if tmdb_match:
-                    content_type = tmdb_match.group(1)
-                    tmdb_id = int(tmdb_match.group(2))
-                    
-                    title = result.get_text(strip=True)
-                    title = re.sub(r'\s*[-—]\s*The Movie Database.*', '', title, flags=re.IGNORECASE)
-                    title = re.sub(r'\s*\|\s*TMDB.*', '', title, flags=re.IGNORECASE)
-                    
-                    year = ''
-                    year_match = re.search(r'\((\d{4})\)', title)
-                    if year_match:
-                        year = year_match.group(1)
-                        title = re.sub(r'\s*\(\d{4}\)', '', title).strip()
-                    
-                    results.append({
-                        'type': content_type,
-                        'id': tmdb_id,
-                        'title': title,
-                        'year': year,
-                        'similarity': 1.0 - (len(results) * 0.1),
-                        'popularity': 100 - len(results) * 10
-                    })
-                    
-                    if len(results) >= max_results:
-                        break
-            return results
+            return self._parse_duckduckgo(response.text, max_results)
         except Exception as e:
             print(f"DuckDuckGo search failed: {e}")
             return []
 
+    def _parse_duckduckgo(self, page, max_results):
+        results = []
+        for href, text in self._duckduckgo_links(page):
+            if 'uddg=' in href:
+                actual_url = unquote(href.split('uddg=')[1].split('&')[0])
+            else:
+                actual_url = href
+            
+            tmdb_match = re.search(r'themoviedb\.org/(movie|tv)/(\d+)', actual_url)
+            if tmdb_match:
+                content_type = tmdb_match.group(1)
+                tmdb_id = int(tmdb_match.group(2))
+                
+                title = re.sub(r'\s*[-—]\s*The Movie Database.*', '', text, flags=re.IGNORECASE)
+                title = re.sub(r'\s*\|\s*TMDB.*', '', title, flags=re.IGNORECASE)
+                
+                year = ''
+                year_match = re.search(r'\((\d{4})\)', title)
+                if year_match:
+                    year = year_match.group(1)
+                    title = re.sub(r'\s*\(\d{4}\)', '', title).strip()
+                
+                results.append({
+                    'type': content_type,
+                    'id': tmdb_id,
+                    'title': title,
+                    'year': year,
+                    'similarity': 1.0 - (len(results) * 0.1),
+                    'popularity': 100 - len(results) * 10
+                })
+                
+                if len(results) >= max_results:
+                    break
+        return results
+
     def _search_direct(self, query, max_results):
         try:
             search_url = f"https://www.themoviedb.org/search?query={quote(query)}"
             response = self.session.get(search_url, timeout=10)
-            from bs4 import BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            results = []
-            cards = soup.find_all('div', class_='card')
-            
-            for card in cards[:max_results]:
-                try:
-                    link = card.find('a', class_='result')
-                    if not link:
-                        continue
-                    
-                    href = link.get('href', '')
-                    match = re.search(r'/(movie|tv)/(\d+)', href)
-                    if not match:
-                        continue
-                    
-                    content_type = match.group(1)
-                    tmdb_id = int(match.group(2))
-                    
-                    title_elem = card.find('h2')
-                    if not title_elem:
-                        continue
-                    
-                    title = title_elem.get_text(strip=True)
-                    
-                    year = ''
-                    year_elem = card.find('span', class_='release_date')
-                    if year_elem:
-                        year_match = re.search(r'\d{4}', year_elem.get_text())
-                        if year_match:
-                            year = year_match.group(0)
-                    
-                    results.append({
-                        'type': content_type,
-                        'id': tmdb_id,
-                        'title': title,
-                        'year': year,
-                        'similarity': 1.0 - (len(results) * 0.1),
-                        'popularity': 100 - len(results) * 10
-                    })
-                except Exception:
-                    continue
-            return results
+            return self._parse_direct(response.text, max_results)
         except Exception as e:
             print(f"Direct TMDB search failed: {e}")
             return []
 
+    def _parse_direct(self, page, max_results):
+        results = []
+        for href, title, release in self._tmdb_cards(page)[:max_results]:
+            if not href:
+                continue
+            
+            match = re.search(r'/(movie|tv)/(\d+)', href)
+            if not match or not title:
+                continue
+            
+            year = ''
+            year_match = re.search(r'\d{4}', release)
+            if year_match:
+                year = year_match.group(0)
+            
+            results.append({
+                'type': match.group(1),
+                'id': int(match.group(2)),
+                'title': title,
+                'year': year,
+                'similarity': 1.0 - (len(results) * 0.1),
+                'popularity': 100 - len(results) * 10
+            })
+        return results
+
+    def season_episode_count(self, tmdb_id, season):
+        try:
+            url = f"https://www.themoviedb.org/tv/{tmdb_id}/season/{season}"
+            response = self.session.get(url, timeout=10)
+            response.raise_for_status()
+            # episode links carry the show slug, e.g. /tv/1396-breaking-bad/season/2/episode/5
+            numbers = re.findall(rf'/tv/{tmdb_id}[^/"]*/season/{season}/episode/(\d+)', response.text)
+            return max(int(n) for n in numbers) if numbers else None
+        except Exception as e:
+            print(f"Episode lookup failed: {e}")
+            return None
+
 
 class VidlinkCapture:
-    def __init__(self, brave_path=None, headless=True):
+    PREFERRED_DOMAINS = ['storm.vodvidl', 'vodvidl', 'hailmist', 'frostveil']
+
+    def __init__(self, brave_path=None, headless=True, pool_size=1, cache=None, time_budget=1800):
         if brave_path is None:
             import platform
             system = platform.system()
@@ -144,18 +538,30 @@ class VidlinkCapture:
         
         self.brave_path = brave_path
         self.headless = headless
-
-    def get_m3u8_url(self, tmdb_id, content_type, season=1, episode=1, wait_time=10):
-        if content_type == 'movie':
-            url = f"https://vidlink.pro/movie/{tmdb_id}"
-        else:
-            url = f"https://vidlink.pro/tv/{tmdb_id}/{season}/{episode}"
+        self.cache = cache
+        # seconds a download may take when the quality is picked with -auto
+        self.time_budget = time_budget
+        # the variant the last download_playlist call picked from a master
+        self.rendition = None
+        self.session = requests.Session()
+        self.session.headers.update({
+            "sec-ch-ua-platform": '"Android"',
+            "Referer": "https://vidlink.pro/",
+            "sec-ch-ua": '"Chromium";v="140", "Not=A?Brand";v="24", "Brave";v="140"',
+            "sec-ch-ua-mobile": "?1",
+            "User-Agent": "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36"
+        })
         
+        # warm browsers are kept between captures; at most pool_size exist at once
+        self.pool_size = pool_size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.drivers = []
+        self.lock = threading.Lock()
+
+    def _new_driver(self):
         from selenium import webdriver
         from selenium.webdriver.chrome.options import Options
-        from selenium.webdriver.common.by import By
-        import json
-        import time
         
         options = Options()
         options.binary_location = self.brave_path
@@ -176,362 +582,3184 @@ class VidlinkCapture:
         options.add_argument('--disable-renderer-backgrounding')
         options.add_argument('--disable-backgrounding-occluded-windows')
         
+        driver = webdriver.Chrome(options=options)
+        with self.lock:
+            self.drivers.append(driver)
+        return driver
+
+    def _acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._new_driver()
+        except:
+            self.slots.release()
+            raise
+
+    def _release(self, driver, healthy=True):
+        if healthy:
+            try:
+                # leave the page so the next capture starts from a quiet
+                # browser, and drain whatever is still in the log buffer
+                driver.get('about:blank')
+                driver.get_log('performance')
+                self.idle.put(driver)
+            except Exception:
+                healthy = False
+        if not healthy:
+            self._discard(driver)
+        self.slots.release()
+
+    def _discard(self, driver):
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            drivers, self.drivers = self.drivers, []
+            self.idle = queue.LifoQueue()
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+    def get_m3u8_url(self, tmdb_id, content_type, season=1, episode=1, timeout=20, poll_interval=0.25, grace=1.0, mirrors=False, mirror_window=5.0):
+        if content_type == 'movie':
+            url = f"https://vidlink.pro/movie/{tmdb_id}"
+        else:
+            url = f"https://vidlink.pro/tv/{tmdb_id}/{season}/{episode}"
+        
+        key = (tmdb_id, content_type, season, episode) if content_type != 'movie' else (tmdb_id, content_type, None, None)
+        # a capture that waited for mirrors is cached under its own key: it
+        # also serves plain runs, but a single-URL capture never serves a
+        # mirrors run
+        keys = [key + ('mirrors',)] if mirrors else [key, key + ('mirrors',)]
+        if self.cache:
+            for cache_key in keys:
+                cached = self.cache.get(cache_key)
+                if cached and self._is_playlist_alive(cached[0]):
+                    metrics.count('capture_cache_hits')
+                    return cached
+                if cached:
+                    self.cache.discard(cache_key)
+        
+        with metrics.span('browser', url=url) as span:
+            captured_urls = self.capture(url, timeout, poll_interval, grace, mirror_window if mirrors else 0)
+            span['captured'] = len(captured_urls or [])
+        if captured_urls and self.cache:
+            self.cache.put(keys[0], captured_urls)
+        return captured_urls
+
+    def _is_playlist_alive(self, m3u8_url):
+        # signed playlist URLs expire well before the cache TTL might, so a
+        # cached URL is only reused if the playlist still answers
+        try:
+            with self.session.get(m3u8_url, timeout=10, stream=True) as response:
+                if response.status_code != 200:
+                    return False
+                head = next(response.iter_content(64), b'')
+                return head.lstrip(b'\xef\xbb\xbf \r\n\t').startswith(b'#EXTM3U')
+        except Exception:
+            return False
+
+    def capture(self, url, timeout=20, poll_interval=0.25, grace=1.0, mirror_window=0):
+        from selenium.webdriver.common.by import By
+        import json
+        
         driver = None
-        captured_urls = []
+        healthy = True
+        all_m3u8_urls = []
         
         try:
-            driver = webdriver.Chrome(options=options)
+            driver = self._acquire()
             driver.get(url)
-            time.sleep(3)
-            
-            try:
-                videos = driver.find_elements(By.CSS_SELECTOR, 'video')
-                for video in videos:
-                    driver.execute_script("arguments[0].play();", video)
-                    break
-            except:
-                pass
-            
-            time.sleep(wait_time)
             
-            logs = driver.get_log('performance')
-            all_m3u8_urls = []
-            
-            for log in logs:
-                try:
-                    log_data = json.loads(log['message'])
-                    message = log_data.get('message', {})
-                    
-                    if message.get('method') == 'Network.requestWillBeSent':
+            # poll the performance log and return on the first playlist request
+            # instead of sleeping a fixed time; timeout is only the upper bound.
+            # With a mirror_window the player gets that long after the first
+            # playlist to fail over to its other hosts, so they are seen too
+            deadline = time.time() + timeout
+            first_seen = None
+            preferred_seen = None
+            played = False
+            while time.time() < deadline:
+                for log in driver.get_log('performance'):
+                    try:
+                        message = json.loads(log['message']).get('message', {})
+                        if message.get('method') != 'Network.requestWillBeSent':
+                            continue
                         request_url = message.get('params', {}).get('request', {}).get('url', '')
-                        
-                        if '.m3u8' in request_url:
-                            if request_url not in all_m3u8_urls:
-                                all_m3u8_urls.append(request_url)
-                except:
-                    continue
-            
-            for m3u8_url in all_m3u8_urls:
-                if any(domain in m3u8_url for domain in ['storm.vodvidl', 'vodvidl', 'hailmist', 'frostveil']):
-                    captured_urls.append(m3u8_url)
-            
-            if not captured_urls:
-                captured_urls = all_m3u8_urls
+                        if '.m3u8' in request_url and request_url not in all_m3u8_urls:
+                            all_m3u8_urls.append(request_url)
+                    except:
+                        continue
+                
+                if any(self._is_preferred(u) for u in all_m3u8_urls):
+                    preferred_seen = preferred_seen or time.time()
+                    if time.time() - preferred_seen >= mirror_window:
+                        break
+                elif all_m3u8_urls:
+                    # an unknown host answered first; give a known one a moment
+                    first_seen = first_seen or time.time()
+                    if time.time() - first_seen >= grace:
+                        break
+                
+                if not played:
+                    try:
+                        for video in driver.find_elements(By.CSS_SELECTOR, 'video'):
+                            driver.execute_script("arguments[0].play();", video)
+                            played = True
+                            break
+                    except:
+                        pass
+                
+                time.sleep(poll_interval)
                 
         except Exception as e:
             print(f"Error capturing m3u8: {e}")
+            healthy = False
         finally:
             if driver:
-                driver.quit()
+                self._release(driver, healthy)
         
+        captured_urls = [u for u in all_m3u8_urls if self._is_preferred(u)] or all_m3u8_urls
         return captured_urls if captured_urls else None
+
+    def _is_preferred(self, m3u8_url):
+        return any(domain in m3u8_url for domain in self.PREFERRED_DOMAINS)
     
-    def download_playlist(self, m3u8_url, output_file, quality_preference='highest'):
-        session = requests.Session()
-        session.headers.update({
-            "sec-ch-ua-platform": '"Android"',
-            "Referer": "https://vidlink.pro/",
-            "sec-ch-ua": '"Chromium";v="140", "Not=A?Brand";v="24", "Brave";v="140"',
-            "sec-ch-ua-mobile": "?1",
-            "User-Agent": "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36"
-        })
+    def download_playlist(self, m3u8_url, output_file, quality_preference='highest', rendition=None):
+        # with a rendition (a variant another host's master gave) only that
+        # same variant is accepted, so a mirror never serves a different
+        # quality than the primary
+        session = self.session
+        self.rendition = None
         
         try:
             response = session.get(m3u8_url, timeout=30)
             response.raise_for_status()
             content = response.text
+            playlist = HLSPlaylist.parse(content, response.url)
+            
+            if not playlist.is_master:
+                # saved with absolute URIs so the download stage does not need
+                # to know where the playlist came from
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    f.write(absolutize_playlist(content, response.url))
+                return output_file
             
             with open(output_file, 'w', encoding='utf-8') as f:
                 f.write(content)
             
-            lines = content.strip().split('\n')
-            is_master = any('EXT-X-STREAM-INF' in line for line in lines)
+            variant = None
+            if rendition:
+                variant = next((v for v in playlist.variants if (v['resolution'], v['bandwidth']) == (rendition['resolution'], rendition['bandwidth'])), None)
+                if not variant:
+                    print(f"No {rendition['resolution'] or rendition['bandwidth']} rendition on {urlparse(m3u8_url).netloc}")
+                    return None
+            elif quality_preference == 'auto':
+                with metrics.span('probe'):
+                    variant = probe_variants(playlist.variants, session, self.time_budget)
+            variant = variant or select_variant(playlist.variants, quality_preference)
+            self.rendition = variant
             
-            if is_master:
-                quality_streams = []
-                for i, line in enumerate(lines):
-                    if 'EXT-X-STREAM-INF' in line:
-                        resolution = 'unknown'
-                        if 'RESOLUTION=' in line:
-                            resolution = line.split('RESOLUTION=')[1].split(',')[0]
-                        
-                        stream_url = lines[i+1] if i+1 < len(lines) else ''
-                        quality_streams.append({
-                            'resolution': resolution,
-                            'url': stream_url
-                        })
-                
-                if quality_preference == 'highest':
-                    selected_stream = quality_streams[0]
-                elif quality_preference == 'lowest':
-                    selected_stream = quality_streams[-1]
-                elif quality_preference == '360p':
-                    selected_stream = next(
-                        (s for s in quality_streams if '360' in s['resolution']),
-                        quality_streams[-1]  # fallback to lowest
-                    )
-                elif quality_preference == '720p':
-                    selected_stream = next(
-                        (s for s in quality_streams if '720' in s['resolution']),
-                        quality_streams[0]  # fallback to highest
-                    )
-                elif quality_preference == '1080p':
-                    selected_stream = next(
-                        (s for s in quality_streams if '1080' in s['resolution']),
-                        quality_streams[0]  # fallback to highest
-                    )
-                else:
-                    selected_stream = next(
-                        (s for s in quality_streams if quality_preference in s['resolution']),
-                        quality_streams[0]
-                    )
-                
-                stream_url = selected_stream['url']
-                
-                if stream_url.startswith('/'):
-                    base_url = m3u8_url.split('/proxy/')[0] if '/proxy/' in m3u8_url else 'https://storm.vodvidl.site'
-                    stream_url = base_url + stream_url
-                
-                segment_file = output_file.replace('.m3u8', f'_segments.m3u8')
-                response = session.get(stream_url, timeout=30)
-                response.raise_for_status()
-                
-                with open(segment_file, 'w', encoding='utf-8') as f:
-                    f.write(response.text)
-                
-                return segment_file
-            else:
-                return output_file
+            segment_file = output_file.replace('.m3u8', f'_segments.m3u8')
+            response = session.get(variant['uri'], timeout=30)
+            response.raise_for_status()
+            
+            with open(segment_file, 'w', encoding='utf-8') as f:
+                f.write(absolutize_playlist(response.text, response.url))
+            
+            return segment_file
                 
         except Exception as e:
             print(f"Error downloading playlist: {e}")
             return None
 
 
-def create_session(pool_connections=30, pool_maxsize=30):
-    session = requests.Session()
-    
-    adapter = HTTPAdapter(
-        pool_connections=pool_connections,
-        pool_maxsize=pool_maxsize,
-        max_retries=Retry(
-            total=3,
-            backoff_factor=0.5,
-            status_forcelist=[429, 500, 502, 503, 504]
-        )
-    )
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    
-    session.headers.update({
-        "sec-ch-ua-platform": '"Android"',
-        "Referer": "https://vidlink.pro/",
-        "sec-ch-ua": '"Chromium";v="140", "Not=A?Brand";v="24", "Brave";v="140"',
-        "sec-ch-ua-mobile": "?1",
-        "User-Agent": "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36"
-    })
-    
-    return session
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+URI_ATTRIBUTE_RE = re.compile(r'URI="([^"]*)"')
 
 
-def download_segment(segment_info, session, base_url):
-    i, segment_url = segment_info
-    full_url = base_url + segment_url
-    
-    try:
-        response = session.get(full_url, timeout=20)
-        response.raise_for_status()
-        return (i, response.content, None)
-    except Exception as e:
-        return (i, None, e)
+def parse_attributes(value):
+    return {name: raw.strip('"') for name, raw in ATTRIBUTE_RE.findall(value)}
 
 
-def download_m3u8_video(m3u8_file, output_file, max_workers=20, base_url="https://storm.vodvidl.site"):
-    if not os.path.exists(m3u8_file):
-        print(f"✗ M3U8 file not found: {m3u8_file}")
-        return False
-    
-    with open(m3u8_file, 'r') as f:
-        lines = f.readlines()
+def parse_byterange(value, default_offset=0):
+    # "<length>[@<offset>]"; without an offset the range follows the previous
+    # one for the same resource
+    length, _, offset = value.partition('@')
+    return (int(offset) if offset else default_offset, int(length))
 
-    segment_urls = [line.strip() for line in lines if line.strip() and not line.startswith('#')]
 
-    if not segment_urls:
-        print("✗ No segment URLs found in the m3u8 file.")
-        return False
+class HLSPlaylist:
+    def __init__(self, url=''):
+        self.url = url
+        self.variants = []
+        self.segments = []
+        self.init_section = None
+        self.target_duration = None
+        self.media_sequence = 0
+        self.endlist = False
 
-    session = create_session(pool_connections=max_workers, pool_maxsize=max_workers)
-    
-    segments_data = {}
-    failed_segments = []
-    
-    start_time = time.time()
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_segment = {
-            executor.submit(download_segment, (i, url), session, base_url): i 
-            for i, url in enumerate(segment_urls)
-        }
-        
-        completed = 0
-        last_print_time = start_time
+    @property
+    def is_master(self):
+        return bool(self.variants)
+
+    def resolve(self, uri):
+        return urljoin(self.url, uri) if self.url else uri
+
+    @classmethod
+    def parse(cls, text, url=''):
+        playlist = cls(url)
+        duration = None
+        byterange = None
+        key = None
+        variant = None
+        range_ends = {}
         
-        for future in as_completed(future_to_segment):
-            i, content, error = future.result()
-            completed += 1
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
             
-            if error:
-                failed_segments.append(i)
-            else:
-                segments_data[i] = content
+            if line.startswith('#'):
+                tag, _, value = line.partition(':')
+                if tag == '#EXT-X-STREAM-INF':
+                    attrs = parse_attributes(value)
+                    resolution = attrs.get('RESOLUTION', 'unknown')
+                    height = resolution.split('x')[1] if 'x' in resolution else ''
+                    variant = {
+                        'bandwidth': int(attrs.get('BANDWIDTH', 0) or 0),
+                        'resolution': resolution,
+                        'height': int(height) if height.isdigit() else None,
+                        'codecs': attrs.get('CODECS', ''),
+                    }
+                elif tag == '#EXTINF':
+                    duration = float(value.split(',')[0] or 0)
+                elif tag == '#EXT-X-BYTERANGE':
+                    byterange = value
+                elif tag == '#EXT-X-MAP':
+                    attrs = parse_attributes(value)
+                    playlist.init_section = {
+                        'uri': playlist.resolve(attrs['URI']),
+                        'duration': 0,
+                        'byterange': parse_byterange(attrs['BYTERANGE']) if 'BYTERANGE' in attrs else None,
+                        'key': key,
+                        'sequence': None,
+                    }
+                elif tag == '#EXT-X-KEY':
+                    attrs = parse_attributes(value)
+                    if attrs.get('METHOD', 'NONE') == 'NONE':
+                        key = None
+                    else:
+                        key = {'method': attrs['METHOD'], 'uri': playlist.resolve(attrs.get('URI', '')), 'iv': attrs.get('IV')}
+                elif tag == '#EXT-X-TARGETDURATION':
+                    playlist.target_duration = float(value)
+                elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                    playlist.media_sequence = int(value)
+                elif tag == '#EXT-X-ENDLIST':
+                    playlist.endlist = True
+                continue
             
-            current_time = time.time()
-            if current_time - last_print_time >= 0.5 or completed % 20 == 0 or completed == len(segment_urls):
-                elapsed = current_time - start_time
-                rate = completed / elapsed if elapsed > 0 else 0
-                percent = (completed / len(segment_urls)) * 100
-                
-                total_bytes = sum(len(segments_data[i]) for i in segments_data)
-                speed_mbps = (total_bytes * 8) / (elapsed * 1_000_000) if elapsed > 0 else 0
-                
-                bar_length = 40
-                filled_length = int(bar_length * completed // len(segment_urls))
-                bar = '█' * filled_length + '-' * (bar_length - filled_length)
-                
-                print(f"\r|{bar}| {percent:.1f}% | {rate:.1f}/s | {speed_mbps:.2f}Mbps | {completed}/{len(segment_urls)}", end='', flush=True)
-                
-                last_print_time = current_time
+            uri = playlist.resolve(line)
+            if variant is not None:
+                variant['uri'] = uri
+                playlist.variants.append(variant)
+                variant = None
+                continue
+            
+            segment_range = None
+            if byterange is not None:
+                segment_range = parse_byterange(byterange, range_ends.get(uri, 0))
+                range_ends[uri] = segment_range[0] + segment_range[1]
+            playlist.segments.append({
+                'uri': uri,
+                'duration': duration,
+                'byterange': segment_range,
+                'key': key,
+                'sequence': playlist.media_sequence + len(playlist.segments),
+            })
+            duration = None
+            byterange = None
+        
+        return playlist
+
+
+def absolutize_playlist(text, url):
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            line = urljoin(url, stripped)
+        elif 'URI="' in stripped:
+            line = URI_ATTRIBUTE_RE.sub(lambda m: f'URI="{urljoin(url, m.group(1))}"', line)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def select_variant(variants, preference='highest'):
+    ranked = sorted(variants, key=lambda v: (v['bandwidth'], v['height'] or 0))
+    if preference == 'highest':
+        return ranked[-1]
+    if preference == 'lowest':
+        return ranked[0]
     
-    print()
+    match = re.match(r'(\d+)p?$', preference)
+    if match and any(v['height'] for v in ranked):
+        # the best stream at the requested height, otherwise the best one
+        # below it, otherwise the smallest there is
+        height = int(match.group(1))
+        exact = [v for v in ranked if v['height'] == height]
+        if exact:
+            return exact[-1]
+        below = [v for v in ranked if v['height'] and v['height'] < height]
+        if below:
+            return max(below, key=lambda v: (v['height'], v['bandwidth']))
+        return ranked[0]
     
-    if failed_segments:
-        print(f"Retrying {len(failed_segments)} failed segments...")
-        retry_success = 0
-        
-        for i in failed_segments[:]:
-            _, content, error = download_segment((i, segment_urls[i]), session, base_url)
-            if not error:
-                segments_data[i] = content
-                failed_segments.remove(i)
-                retry_success += 1
-        
-        print(f"Retry successful: {retry_success}/{len(failed_segments) + retry_success}")
+    return next((v for v in reversed(ranked) if preference in v['resolution']), ranked[-1])
+
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}h{minutes % 60:02d}m" if minutes >= 60 else f"{minutes}m{int(seconds % 60):02d}s"
+
+
+def probe_variants(variants, session, time_budget=1800, sample=3, probe_time=8.0):
+    # fetches the first few segments of every variant at once; together they
+    # show what the link sustains with many connections open, and each
+    # variant's segment sizes give its real bitrate, so the time to download
+    # each one can be estimated; returns the highest bandwidth that fits the
+    # budget. Reads stop at probe_time so a slow link is not probed for long
+    segment_session = create_session(pool_connections=len(variants) * sample, pool_maxsize=len(variants) * sample)
+    deadline = time.time() + probe_time
     
-    print(f"Writing segments to {output_file}...")
-    missing_count = 0
+    def read(segment):
+        headers = range_header(segment['byterange']) if segment['byterange'] else None
+        with segment_session.get(segment['uri'], timeout=10, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length', '')
+            size = segment['byterange'][1] if segment['byterange'] else int(length) if length.isdigit() else None
+            received = 0
+            for chunk in response.iter_content(SHAPED_CHUNK_SIZE):
+                received += len(chunk)
+                if time.time() > deadline:
+                    break
+            return received, size or received
     
-    with open(output_file, 'wb') as f_out:
-        for i in range(len(segment_urls)):
-            if i in segments_data:
-                f_out.write(segments_data[i])
-            else:
-                missing_count += 1
+    def probe(variant):
+        try:
+            response = session.get(variant['uri'], timeout=10)
+            response.raise_for_status()
+            playlist = HLSPlaylist.parse(response.text, response.url)
+            segments = playlist.segments[:sample]
+            if not segments:
+                return None
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                results = list(executor.map(read, segments))
+        except Exception:
+            return None
+        media = sum(s['duration'] or 0 for s in segments)
+        return {
+            'variant': variant,
+            'start': start,
+            'end': time.time(),
+            'bytes': sum(received for received, _ in results),
+            'partial': any(received < size for received, size in results),
+            'duration': sum(s['duration'] or 0 for s in playlist.segments),
+            'bitrate': sum(size for _, size in results) * 8 / media if media else variant['bandwidth'],
+        }
     
-    total_time = time.time() - start_time
-    total_bytes = sum(len(segments_data[i]) for i in segments_data)
-    total_mb = total_bytes / (1024 * 1024)
-    avg_speed_mbps = (total_bytes * 8) / (total_time * 1_000_000)
+    print(f"Probing {len(variants)} variants...")
+    with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+        probes = [p for p in executor.map(probe, variants) if p]
+    segment_session.close()
+    if not probes:
+        print("Probe failed; falling back to the highest quality")
+        return None
     
-    print(f"Download Complete!")
-    print(f"File: {output_file}")
-    print(f"Size: {total_mb:.2f} MB")
-    print(f"Time: {total_time:.2f}s")
-    print(f"Speed: {avg_speed_mbps:.2f} Mbps")
+    window = max(p['end'] for p in probes) - min(p['start'] for p in probes)
+    capacity = sum(p['bytes'] for p in probes) * 8 / max(window, 1e-6)
+    for p in probes:
+        p['estimate'] = p['duration'] * p['bitrate'] / capacity
     
-    if missing_count > 0:
-        print(f"Warning: {missing_count} segments missing")
+    fitting = [p for p in probes if p['estimate'] <= time_budget]
+    chosen = max(fitting, key=lambda p: p['variant']['bandwidth']) if fitting else min(probes, key=lambda p: p['estimate'])
+    for p in sorted(probes, key=lambda p: p['variant']['bandwidth'], reverse=True):
+        variant = p['variant']
+        rate = p['bytes'] * 8 / max(p['end'] - p['start'], 1e-6)
+        print(f"  {'>' if p is chosen else ' '} {variant['resolution'] or '?':>9} {variant['bandwidth'] // 1000:>6} kbps: "
+              f"{p['bytes'] / 1_000_000:.1f} MB in {p['end'] - p['start']:.2f}s{' (cut short)' if p['partial'] else ''} at {rate / 1_000_000:.1f} Mbps, "
+              f"full download ~{format_duration(p['estimate'])}")
+    verdict = "fits" if fitting else "is the quickest, but does not fit"
+    print(f"Link sustains {capacity / 1_000_000:.1f} Mbps; {chosen['variant']['resolution'] or 'the chosen variant'} {verdict} the {format_duration(time_budget)} budget")
+    return chosen['variant']
+
+
+def coalesce_segments(indices, segments, max_bytes=8 * 1024 * 1024):
+    # neighbouring byte ranges of the same resource are fetched as one Range
+    # request; sizes lets the response be split back into segments
+    units = []
+    for i in indices:
+        segment = segments[i]
+        last = units[-1] if units else None
+        if (last and segment['byterange'] and last['byterange']
+                and segment['uri'] == last['uri']
+                and last['indices'][-1] == i - 1
+                and segment['byterange'][0] == last['byterange'][0] + last['byterange'][1]
+                and last['byterange'][1] + segment['byterange'][1] <= max_bytes):
+            last['indices'].append(i)
+            last['sizes'].append(segment['byterange'][1])
+            last['byterange'] = (last['byterange'][0], last['byterange'][1] + segment['byterange'][1])
+            continue
+        units.append({
+            'indices': [i],
+            'uri': segment['uri'],
+            'byterange': segment['byterange'],
+            'sizes': [segment['byterange'][1]] if segment['byterange'] else None,
+        })
+    return units
+
+
+def split_unit(unit, content):
+    if not unit['sizes'] or len(unit['indices']) == 1:
+        return [content]
+    if len(content) != sum(unit['sizes']):
+        raise IOError(f"expected {sum(unit['sizes'])} bytes for a coalesced range, got {len(content)}")
+    pieces = []
+    offset = 0
+    for size in unit['sizes']:
+        pieces.append(content[offset:offset + size])
+        offset += size
+    return pieces
+
+
+def playlists_equivalent(primary, other):
+    # mirrors are interchangeable only if they cut the title the same way
+    if len(primary) != len(other):
         return False
-    
+    for a, b in zip(primary, other):
+        if abs((a['duration'] or 0) - (b['duration'] or 0)) >= 0.001:
+            return False
+        if a['byterange'] and b['byterange'] and a['byterange'][1] != b['byterange'][1]:
+            return False
     return True
 
 
-def parse_command_line():
-    args = sys.argv[1:]
-    if not args:
-        return None, None, None, '720p'
+def probe_mirror(segment, timeout=5):
+    # one byte of a segment, without the session's retries, so a dead mirror
+    # is dropped up front instead of stalling its first batch of fetches.
+    # Returns the segment's size as the host reports it (a different
+    # rendition cut at the same points has the same durations but not the
+    # same sizes), 0 when the host does not say, or None when it is not
+    # answering
+    if segment['byterange']:
+        offset, size = segment['byterange']
+    else:
+        offset, size = 0, None
+    try:
+        response = requests.get(segment['uri'], headers={**SEGMENT_HEADERS, **range_header((offset, 1))}, timeout=timeout, stream=True)
+        response.close()
+    except Exception:
+        return None
+    if response.status_code not in (200, 206):
+        return None
+    if size is None:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        length = response.headers.get('Content-Length', '')
+        if response.status_code == 206:
+            size = int(total) if total.isdigit() else 0
+        else:
+            size = int(length) if length.isdigit() and not response.headers.get('Content-Encoding') else 0
+    return size
+
+
+def unit_request(unit, segments):
+    # the same unit on another mirror, or None when that mirror's byte ranges
+    # would not split back into the same segments
+    first = segments[unit['indices'][0]]
+    if len(unit['indices']) == 1:
+        return first['uri'], first['byterange']
+    
+    expected = first['byterange'][0] if first['byterange'] else None
+    for i, size in zip(unit['indices'], unit['sizes']):
+        segment = segments[i]
+        if segment['uri'] != first['uri'] or segment['byterange'] != (expected, size):
+            return None
+        expected += size
+    return first['uri'], (first['byterange'][0], sum(unit['sizes']))
+
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# how often the transport retries a request before giving it back
+STATUS_RETRIES = 3
+
+DEFAULT_BASE_URL = "https://storm.vodvidl.site"
+
+SEGMENT_HEADERS = {
+    "sec-ch-ua-platform": '"Android"',
+    "Referer": "https://vidlink.pro/",
+    "sec-ch-ua": '"Chromium";v="140", "Not=A?Brand";v="24", "Brave";v="140"',
+    "sec-ch-ua-mobile": "?1",
+    "User-Agent": "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36"
+}
+
+
+def create_session(pool_connections=30, pool_maxsize=30, retry_statuses=True):
+    session = requests.Session()
+    
+    # with retry_statuses off, 429 and 5xx answers come back as errors at
+    # once so the concurrency controller sees them
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=STATUS_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES if retry_statuses else [],
+            # urllib3 otherwise still retries a 429 or 503 that has Retry-After
+            respect_retry_after_header=retry_statuses
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    session.headers.update(SEGMENT_HEADERS)
+    
+    return session
+
+
+def range_header(byterange):
+    offset, length = byterange
+    return {'Range': f"bytes={offset}-{offset + length - 1}"}
+
+
+def trim_to_range(content, status, byterange):
+    # an origin that ignores Range answers 200 with the whole resource
+    if byterange and status == 200:
+        offset, length = byterange
+        return content[offset:offset + length]
+    return content
+
+
+def checked_body(content, status, headers, byterange):
+    # a connection that drops mid-body must not pass for a short segment
+    expected = headers.get('Content-Length')
+    if expected and not headers.get('Content-Encoding') and expected.isdigit() and int(expected) != len(content):
+        raise IOError(f"short read: got {len(content)} of {expected} bytes")
+    content = trim_to_range(content, status, byterange)
+    if byterange and len(content) != byterange[1]:
+        raise IOError(f"short read: got {len(content)} of {byterange[1]} bytes for the range")
+    return content
+
+
+def validate_segment(content, segment=None, mpegts=True):
+    # returns why content cannot be a segment of the title, or None; the
+    # sync byte check slices out every 188th byte in one go, so it runs at
+    # memory speed rather than once per packet in Python
+    if not content:
+        return "empty response"
+    if not mpegts or (segment and segment['sequence'] is None):
+        # fMP4 fragments and init sections are opaque here; encrypted segments
+        # are only checked after decryption
+        return None
+    if content[0] != 0x47:
+        kind = 'an HTML page' if content.lstrip()[:1] == b'<' else f"0x{content[0]:02x}"
+        return f"not MPEG-TS: starts with {kind}"
+    if len(content) % TS_PACKET_SIZE:
+        return f"truncated: {len(content)} bytes is not a whole number of {TS_PACKET_SIZE}-byte packets"
+    syncs = content[::TS_PACKET_SIZE]
+    if syncs.count(0x47) != len(syncs):
+        lost = next(k for k, byte in enumerate(syncs) if byte != 0x47)
+        return f"sync byte missing at packet {lost}"
+    return None
+
+
+SHAPED_CHUNK_SIZE = 64 * 1024
+RATE_RE = re.compile(r'(\d+(?:\.\d+)?)([kKmMgG]?)$')
+PRIORITY_WEIGHTS = {'background': 1, 'normal': 4, 'interactive': 16}
+
+
+def parse_rate(value):
+    # bytes per second, with wget-style k/M/G suffixes (powers of 1024)
+    match = RATE_RE.match(str(value).strip())
+    if not match:
+        raise ValueError(f"invalid rate: {value}")
+    return float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2).lower() or ' ')
+
+
+class TokenBucket:
+    # reserve() takes tokens even when there are not enough and returns how
+    # long the caller has to wait for the debt to refill, so concurrent readers
+    # queue up in order instead of polling
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate / 4, 256 * 1024)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, size):
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class HostShare:
+    # downloads on the same host that set a global cap publish their priority
+    # weight in a shared directory and each takes its weighted part of the
+    # cap; entries that stop being refreshed belong to processes that are gone
+    def __init__(self, path, stale=5.0):
+        self.path = path
+        self.stale = stale
+        self.entry = os.path.join(path, f"{os.getpid()}.json")
+
+    def update(self, weight):
+        import json
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = self.entry + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'weight': weight}, f)
+            os.replace(tmp, self.entry)
+            
+            total = 0
+            now = time.time()
+            for name in os.listdir(self.path):
+                entry = os.path.join(self.path, name)
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    if now - os.path.getmtime(entry) > self.stale:
+                        continue
+                    with open(entry, 'r', encoding='utf-8') as f:
+                        total += json.load(f)['weight']
+                except (OSError, ValueError, KeyError):
+                    continue
+            return weight / total if total else 1.0
+        except OSError:
+            return 1.0
+
+    def close(self):
+        try:
+            os.remove(self.entry)
+        except OSError:
+            pass
+
+
+class BandwidthScheduler:
+    # shapes segment reads: a global cap (shared with other processes through
+    # HostShare) is split between open jobs by priority weight, and each job
+    # may have a cap of its own on top; with neither, jobs are not shaped
+    def __init__(self, rate=None, host_share=None, interval=1.0):
+        self.rate = rate
+        self.host_share = host_share if rate else None
+        self.interval = interval
+        self.jobs = []
+        self.fraction = 1.0
+        self.rebalanced = 0
+        self.lock = threading.Lock()
+
+    def open(self, rate=None, priority='normal'):
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(f"unknown priority: {priority}")
+        job = BandwidthJob(self, rate, PRIORITY_WEIGHTS[priority])
+        with self.lock:
+            self.jobs.append(job)
+            self._rebalance()
+        return job
+
+    def close(self, job):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self._rebalance()
+
+    def refresh(self):
+        # other processes come and go, so the host-wide share is looked at again
+        # every interval
+        if self.host_share and time.monotonic() - self.rebalanced >= self.interval:
+            with self.lock:
+                if time.monotonic() - self.rebalanced >= self.interval:
+                    self._rebalance()
+
+    def _rebalance(self):
+        weight = sum(job.weight for job in self.jobs)
+        if self.host_share:
+            if self.jobs:
+                self.fraction = self.host_share.update(weight)
+            else:
+                self.host_share.close()
+        self.rebalanced = time.monotonic()
+        for job in self.jobs:
+            rates = [job.rate] if job.rate else []
+            if self.rate:
+                rates.append(self.rate * self.fraction * job.weight / weight)
+            job.set_rate(min(rates) if rates else None)
+
+
+class BandwidthJob:
+    def __init__(self, scheduler, rate, weight):
+        self.scheduler = scheduler
+        self.rate = rate
+        self.weight = weight
+        self.bucket = None
+
+    def set_rate(self, rate):
+        if rate is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate)
+        else:
+            self.bucket.set_rate(rate)
+
+    def reserve(self, size):
+        # seconds the reader should wait before reading size more bytes
+        self.scheduler.refresh()
+        bucket = self.bucket
+        return bucket.reserve(size) if bucket else 0.0
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+def download_segment(segment_info, session, shaper=None):
+    i, url, byterange = segment_info
+    
+    try:
+        if shaper is None:
+            response = session.get(url, timeout=20, headers=range_header(byterange) if byterange else None)
+            response.raise_for_status()
+            return (i, checked_body(response.content, response.status_code, response.headers, byterange), None)
+        
+        # shaped reads pull the body in chunks and wait for tokens before each
+        with session.get(url, timeout=20, headers=range_header(byterange) if byterange else None, stream=True) as response:
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(SHAPED_CHUNK_SIZE):
+                time.sleep(shaper.reserve(len(chunk)))
+                chunks.append(chunk)
+            return (i, checked_body(b''.join(chunks), response.status_code, response.headers, byterange), None)
+    except Exception as e:
+        return (i, None, e)
+
+
+async def download_segment_async(segment_info, session, retries=STATUS_RETRIES, backoff_factor=0.5, shaper=None, retry_statuses=True):
+    import aiohttp
+    i, url, byterange = segment_info
+    
+    # mirrors the urllib3 Retry policy that create_session mounts for the thread engine
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=range_header(byterange) if byterange else None) as response:
+                if retry_statuses and response.status in RETRY_STATUSES and attempt < retries:
+                    await asyncio.sleep(backoff_factor * (2 ** attempt))
+                    continue
+                response.raise_for_status()
+                if shaper is None:
+                    return (i, checked_body(await response.read(), response.status, response.headers, byterange), None)
+                chunks = []
+                async for chunk in response.content.iter_chunked(SHAPED_CHUNK_SIZE):
+                    await asyncio.sleep(shaper.reserve(len(chunk)))
+                    chunks.append(chunk)
+                return (i, checked_body(b''.join(chunks), response.status, response.headers, byterange), None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                return (i, None, e)
+            await asyncio.sleep(backoff_factor * (2 ** attempt))
+        except Exception as e:
+            return (i, None, e)
+
+
+class ThreadEngine:
+    def __init__(self, max_workers, session=None, retry_statuses=True):
+        # requests cannot be cancelled once sent, so the losing copies of hedged
+        # fetches keep a thread busy; the extra threads keep duplicates from
+        # queueing behind them
+        threads = max_workers + max(2, max_workers // 2)
+        self.session = session or create_session(pool_connections=threads, pool_maxsize=threads, retry_statuses=retry_statuses)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, i, url, byterange=None, shaper=None):
+        return self.executor.submit(download_segment, (i, url, byterange), self.session, shaper)
+
+    def close(self):
+        # only the abandoned copies of hedged fetches can still be running;
+        # their results are never read, so there is nothing to wait for
+        self.executor.shutdown(wait=False)
+
+
+class AsyncEngine:
+    # a single event loop on a background thread drives every fetch; submit()
+    # hands back concurrent.futures.Future objects so the scheduler in
+    # download_m3u8_video can wait on them exactly like thread pool futures
+    def __init__(self, max_connections, retry_statuses=True):
+        import aiohttp
+        self.retry_statuses = retry_statuses
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        
+        async def open_session():
+            connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections, keepalive_timeout=30)
+            return aiohttp.ClientSession(
+                connector=connector,
+                headers=SEGMENT_HEADERS,
+                # per-read like requests' timeout: a shaped fetch spends most
+                # of its time waiting for tokens, which a total cap would count
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=20, sock_read=20)
+            )
+        
+        self.session = asyncio.run_coroutine_threadsafe(open_session(), self.loop).result()
+
+    def submit(self, i, url, byterange=None, shaper=None):
+        return asyncio.run_coroutine_threadsafe(
+            download_segment_async((i, url, byterange), self.session, shaper=shaper, retry_statuses=self.retry_statuses),
+            self.loop
+        )
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def create_engine(engine, max_workers, adaptive=False):
+    # an adaptive download wants throttling reported, not retried away
+    if engine == 'async':
+        try:
+            return AsyncEngine(max_workers, retry_statuses=not adaptive)
+        except ImportError:
+            print("✗ The async engine requires aiohttp (pip install aiohttp)")
+            return None
+    if engine == 'thread':
+        return ThreadEngine(max_workers, retry_statuses=not adaptive)
+    print(f"✗ Unknown download engine: {engine}")
+    return None
+
+
+class SegmentDecryptor:
+    # AES-128 for EXT-X-KEY playlists, as a stage of its own between the
+    # fetch engine and the writer. Keys are fetched once per URI and kept;
+    # OpenSSL releases the GIL while it decrypts, so a pool of threads keeps
+    # up with the network without holding up fetches or copying segments
+    # to other processes
+    def __init__(self, workers=None, session=None):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self.cipher = lambda key, iv: Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self.owns_session = session is None
+        self.session = session or create_session()
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4)
+        self.keys = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def key(self, uri):
+        with self.lock:
+            if uri in self.keys:
+                return self.keys[uri]
+            lock = self.key_locks.setdefault(uri, threading.Lock())
+        # one fetch per key; workers that need it meanwhile wait for that one
+        with lock:
+            with self.lock:
+                if uri in self.keys:
+                    return self.keys[uri]
+            with metrics.span('key', uri=uri):
+                response = self.session.get(uri, timeout=15)
+            response.raise_for_status()
+            if len(response.content) != 16:
+                raise IOError(f"key {uri} is {len(response.content)} bytes, not 16")
+            with self.lock:
+                self.keys[uri] = response.content
+            return response.content
+
+    def decrypt(self, content, segment):
+        # the IV is the key's own when given, otherwise the segment's media
+        # sequence number
+        key = segment['key']
+        if key['iv']:
+            iv = bytes.fromhex(key['iv'][2:] if key['iv'][:2].lower() == '0x' else key['iv']).rjust(16, b'\0')
+        else:
+            iv = (segment['sequence'] or 0).to_bytes(16, 'big')
+        if len(content) % 16:
+            raise IOError(f"{len(content)} bytes is not a whole number of AES blocks")
+        
+        start = time.time()
+        decryptor = self.cipher(self.key(key['uri']), iv)
+        data = decryptor.update(content) + decryptor.finalize()
+        padding = data[-1] if data else 0
+        if not 1 <= padding <= 16 or data[-padding:] != bytes([padding]) * padding:
+            raise IOError("bad padding after decryption (wrong key or IV)")
+        metrics.observe('decrypt', time.time() - start)
+        return data[:-padding]
+
+    def submit(self, segments, pieces):
+        # decrypts the pieces of one unit; the future gives back the
+        # plaintexts in order, unencrypted pieces as they were
+        return self.executor.submit(
+            lambda: [self.decrypt(piece, segment) if segment['key'] else piece for segment, piece in zip(segments, pieces)]
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.owns_session:
+            self.session.close()
+
+
+class ConcurrencyController:
+    # AIMD over windows of completed segments: add workers after every window
+    # without congestion, cut back multiplicatively on throttling or when
+    # latency climbs well past the baseline. The baseline drops to a faster
+    # window at once but drifts up towards slower ones, so one lucky early
+    # window cannot make every later one look congested
+    def __init__(self, initial, minimum=2, maximum=64, increase=2, decrease=0.7, latency_factor=2.0, baseline_alpha=0.2):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.baseline_alpha = baseline_alpha
+        self.baseline_latency = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_latencies = []
+        self.window_throttled = 0
+
+    def record(self, latency, throttled=False):
+        self.window_latencies.append(latency)
+        if throttled:
+            self.window_throttled += 1
+        
+        if len(self.window_latencies) >= max(self.limit, 8):
+            self._adjust()
+
+    def _adjust(self):
+        latencies = sorted(self.window_latencies)
+        median = latencies[len(latencies) // 2]
+        
+        baseline = self.baseline_latency
+        congested = self.window_throttled or (baseline is not None and median > baseline * self.latency_factor)
+        if baseline is None or median < baseline:
+            self.baseline_latency = median
+        else:
+            self.baseline_latency = baseline + self.baseline_alpha * (median - baseline)
+        
+        if congested:
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.maximum, self.limit + self.increase)
+        
+        self._reset_window()
+
+
+class MirrorSelector:
+    # spreads fetches over equivalent mirrors in proportion to the throughput
+    # each has delivered per request (so latency counts too), and benches a
+    # mirror for a growing cooldown while it keeps failing
+    def __init__(self, count, alpha=0.3, failure_threshold=3, cooldown=5.0, max_cooldown=60.0):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.stats = [
+            {'throughput': None, 'latency': None, 'in_flight': 0, 'failures': 0, 'benched_until': 0, 'served': 0}
+            for _ in range(count)
+        ]
+
+    def choose(self, exclude=None, usable=None):
+        now = time.time()
+        allowed = [m for m in range(len(self.stats)) if usable is None or usable(m)]
+        candidates = [m for m in allowed if self.stats[m]['benched_until'] <= now and m != exclude]
+        if not candidates:
+            others = [m for m in allowed if m != exclude] or allowed
+            candidates = [min(others, key=lambda m: self.stats[m]['benched_until'])]
+        
+        # mirrors without a measurement yet are assumed to be as good as the
+        # best one so they get tried early
+        known = [s['throughput'] for s in self.stats if s['throughput']]
+        optimistic = max(known) if known else 1.0
+        weights = [(self.stats[m]['throughput'] or optimistic) / (1 + self.stats[m]['in_flight']) for m in candidates]
+        mirror = random.choices(candidates, weights)[0]
+        self.stats[mirror]['in_flight'] += 1
+        return mirror
+
+    def release(self, mirror):
+        # a fetch that was cancelled says nothing about the mirror
+        self.stats[mirror]['in_flight'] -= 1
+
+    def record(self, mirror, latency, nbytes=0, error=None):
+        stats = self.stats[mirror]
+        stats['in_flight'] -= 1
+        
+        if error:
+            stats['failures'] += 1
+            if stats['throughput']:
+                stats['throughput'] *= 0.5
+            if stats['failures'] >= self.failure_threshold:
+                backoff = self.cooldown * (2 ** (stats['failures'] - self.failure_threshold))
+                stats['benched_until'] = time.time() + min(self.max_cooldown, backoff)
+            return
+        
+        stats['failures'] = 0
+        stats['served'] += 1
+        rate = nbytes / latency if latency > 0 else nbytes
+        for name, value in (('throughput', rate), ('latency', latency)):
+            previous = stats[name]
+            stats[name] = value if previous is None else previous + self.alpha * (value - previous)
+
+
+class HedgePolicy:
+    # a fetch becomes a straggler once it has been in flight longer than the
+    # given percentile of recent successful fetches. At the tail, idle slots
+    # may duplicate fetches past the lower tail_percentile instead. budget
+    # caps how many duplicates either may trigger over the whole run
+    def __init__(self, percentile=0.95, tail_percentile=0.75, min_samples=20, history=200, budget=8):
+        self.percentile = percentile
+        self.tail_percentile = tail_percentile
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=history)
+        self.budget = budget
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def threshold(self, percentile=None):
+        # the straggler threshold is never below twice the median: on a
+        # steady origin a twentieth of all fetches pass the 95th percentile by
+        # definition, and duplicating those would spend the budget before a
+        # real straggler shows up
+        if len(self.latencies) < self.min_samples or self.budget <= 0:
+            return None
+        latencies = sorted(self.latencies)
+        if percentile:
+            return latencies[int(percentile * (len(latencies) - 1))]
+        return max(latencies[int(self.percentile * (len(latencies) - 1))], 2 * latencies[len(latencies) // 2])
+
+
+def retry_delay(attempt, base=0.5, cap=30.0):
+    # exponential backoff with equal jitter so segments that failed together
+    # do not come back as a burst
+    delay = min(cap, base * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_throttle_error(error):
+    if isinstance(error, requests.exceptions.RetryError):
+        return True
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+    return status in RETRY_STATUSES
+
+
+class SegmentJournal:
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.file = None
+
+    def load(self):
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        
+        with open(self.path, 'r') as f:
+            header = f.readline().strip()
+            if header != f"# {self.fingerprint}":
+                return entries
+            for line in f:
+                parts = line.split()
+                if len(parts) != 3:
+                    continue
+                try:
+                    i, offset, size = (int(p) for p in parts)
+                except ValueError:
+                    continue
+                entries[i] = (offset, size)
+        return entries
+
+    def open(self, entries=None):
+        # the journal is rewritten compactly on open so stale lines from an
+        # earlier layout never survive a resume
+        self.file = open(self.path, 'w')
+        self.file.write(f"# {self.fingerprint}\n")
+        for i, (offset, size) in sorted((entries or {}).items()):
+            self.file.write(f"{i} {offset} {size}\n")
+        self.file.flush()
+
+    def record(self, i, offset, size):
+        self.file.write(f"{i} {offset} {size}\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class SegmentWriter:
+    def __init__(self, output_file, window=64, journal=None, resume=False, sink=None):
+        self.window = window
+        self.journal = journal
+        # sink sees every byte of the output in order, e.g. a TSRemuxer
+        self.sink = sink
+        self.next_index = 0
+        self.pending = {}
+        self.carried = {}
+        # journaled segments past the first hole of a resumed file, still at
+        # their old offsets
+        self.placed = {}
+        self.carry_file = None
+        self.carry_path = output_file + '.carry'
+        self.bytes_written = 0
+        self.missing = 0
+        # where each segment sits in the output, so a local player can be
+        # served while the download is still running
+        self.offsets = {}
+        self.skipped = set()
+        self.lock = threading.Condition()
+        self.reader = None
+        self.closed = False
+        self.output_file = output_file
+        
+        entries = journal.load() if (journal and resume and os.path.exists(output_file)) else {}
+        if entries:
+            file_size = os.path.getsize(output_file)
+            entries = {i: e for i, e in entries.items() if e[0] + e[1] <= file_size}
+        
+        if not entries:
+            self.file = open(output_file, 'wb')
+            if journal:
+                journal.open()
+            return
+        
+        # the contiguous run from index 0 stays where it is. Anything
+        # journaled beyond the first hole stays put too, as long as the
+        # segments filling the holes come back the size they were (a repair
+        # of corrupt segments); only once the layout shifts is it moved aside
+        # and spliced back in when the writer reaches it
+        prefix = {}
+        while self.next_index in entries and entries[self.next_index][0] == self.bytes_written:
+            prefix[self.next_index] = entries[self.next_index]
+            self.bytes_written += entries[self.next_index][1]
+            self.next_index += 1
+        
+        self.file = open(output_file, 'r+b')
+        self.placed = {i: e for i, e in entries.items() if i > self.next_index}
+        
+        self.offsets.update(prefix)
+        self.offsets.update(self.placed)
+        if sink and self.bytes_written:
+            self.file.seek(0)
+            _copy_range(self.file, None, self.bytes_written, tee=sink)
+        
+        if not self.placed:
+            self.file.truncate(self.bytes_written)
+        self.file.seek(self.bytes_written)
+        if journal:
+            journal.open(self.offsets)
+        self._flush()
+
+    def is_done(self, i):
+        return i < self.next_index or i in self.carried or i in self.placed
+
+    def can_accept(self, i):
+        # segments further ahead than the reorder window are not fetched until
+        # the writer catches up, which is what bounds memory
+        return i < self.next_index + self.window
+
+    def add(self, i, content):
+        with self.lock:
+            if i >= self.next_index + self.window:
+                # fetched ahead of the window for a player that seeked; kept
+                # on disk rather than in memory until the writer gets there
+                if self.carry_file is None:
+                    self.carry_file = open(self.carry_path, 'w+b')
+                self.carry_file.seek(0, 2)
+                self.carried[i] = (self.carry_file.tell(), len(content))
+                self.carry_file.write(content)
+            else:
+                self.pending[i] = content
+            self._flush()
+            self.lock.notify_all()
+
+    def skip(self, i):
+        with self.lock:
+            self.pending[i] = None
+            self.skipped.add(i)
+            self._flush()
+            self.lock.notify_all()
+
+    def read(self, i, timeout=None):
+        # blocks until segment i has been fetched; None if it was given up on
+        # or did not arrive in time
+        with self.lock:
+            available = lambda: i in self.offsets or i in self.carried or i in self.skipped or self.pending.get(i) is not None or self.closed
+            if not self.lock.wait_for(available, timeout) or i in self.skipped or self.closed:
+                return None
+            if i in self.pending:
+                return self.pending[i]
+            if i in self.carried:
+                offset, size = self.carried[i]
+                self.carry_file.flush()
+                self.carry_file.seek(offset)
+                return self.carry_file.read(size)
+            if i not in self.offsets:
+                return None
+            offset, size = self.offsets[i]
+            if self.reader is None:
+                self.reader = open(self.output_file, 'rb')
+            self.reader.seek(offset)
+            return self.reader.read(size)
+
+    def _flush(self):
+        while self.next_index in self.pending or self.next_index in self.carried or self.next_index in self.placed:
+            offset = self.bytes_written
+            if self.placed:
+                content = self.pending.get(self.next_index)
+                end = offset + (len(content) if content else 0)
+                if end > min(start for start, _ in self.placed.values()) or self.placed.get(self.next_index, (offset,))[0] != offset:
+                    # a segment came back a different size than the one it
+                    # replaces, so everything still placed has to move
+                    self._evacuate()
+                self.file.seek(offset)
+            if self.next_index in self.placed:
+                _, size = self.placed.pop(self.next_index)
+                if self.sink:
+                    _copy_range(self.file, None, size, tee=self.sink)
+                self.bytes_written += size
+                self.file.seek(self.bytes_written)
+                self.next_index += 1
+                continue
+            if self.next_index in self.carried:
+                carry_offset, size = self.carried.pop(self.next_index)
+                self.carry_file.seek(carry_offset)
+                _copy_range(self.carry_file, self.file, size, tee=self.sink)
+            else:
+                content = self.pending.pop(self.next_index)
+                if content is None:
+                    self.missing += 1
+                    self.next_index += 1
+                    continue
+                self.file.write(content)
+                if self.sink:
+                    self.sink.write(content)
+                size = len(content)
+            
+            self.bytes_written += size
+            self.offsets[self.next_index] = (offset, size)
+            if self.journal:
+                self.file.flush()
+                self.journal.record(self.next_index, offset, size)
+            self.next_index += 1
+        self.file.flush()
+
+    def _evacuate(self):
+        if self.carry_file is None:
+            self.carry_file = open(self.carry_path, 'w+b')
+        self.carry_file.seek(0, 2)
+        for i, (offset, size) in sorted(self.placed.items()):
+            self.file.seek(offset)
+            self.carried[i] = (self.carry_file.tell(), size)
+            _copy_range(self.file, self.carry_file, size)
+            del self.offsets[i]
+        self.placed = {}
+        if self.journal:
+            # their old offsets are about to be written over
+            self.journal.close()
+            self.journal.open(self.offsets)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        if not self.placed:
+            # a repair can leave the tail of the old file past the new end
+            self.file.truncate(self.bytes_written)
+        self.file.close()
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if self.journal:
+            self.journal.close()
+        if self.carry_file:
+            self.carry_file.close()
+            self.carry_file = None
+            if not self.carried:
+                os.remove(self.carry_path)
+
+
+def _copy_range(src, dst, size, chunk_size=1024 * 1024, tee=None):
+    while size > 0:
+        chunk = src.read(min(chunk_size, size))
+        if not chunk:
+            raise IOError("unexpected end of file while copying segment")
+        if dst:
+            dst.write(chunk)
+        if tee:
+            tee.write(chunk)
+        size -= len(chunk)
+
+
+TS_PACKET_SIZE = 188
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+STREAM_TYPES = {0x1b: 'video', 0x0f: 'audio'}
+# video and audio codecs that would need a different sample entry
+UNSUPPORTED_STREAM_TYPES = {0x01: 'MPEG-1 video', 0x02: 'MPEG-2 video', 0x24: 'HEVC', 0x03: 'MP3', 0x04: 'MP3', 0x11: 'LATM AAC', 0x81: 'AC-3', 0x87: 'E-AC-3'}
+IDENTITY_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def mp4_box(kind, *payload):
+    body = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+
+def mp4_full_box(kind, version, flags, *payload):
+    return mp4_box(kind, struct.pack('>I', (version << 24) | flags), *payload)
+
+
+def _descriptor(tag, *payload):
+    body = b''.join(payload)
+    return bytes([tag, 0x80, 0x80, 0x80, len(body)]) + body
+
+
+def _pes_timestamp(data):
+    return (((data[0] >> 1) & 0x07) << 30) | (data[1] << 22) | ((data[2] >> 1) << 15) | (data[3] << 7) | (data[4] >> 1)
+
+
+def split_annexb(data):
+    # NAL units come back as memoryview slices of the PES payload
+    view = memoryview(data)
+    units = []
+    position = data.find(b'\x00\x00\x01')
+    while position != -1:
+        begin = position + 3
+        position = data.find(b'\x00\x00\x01', begin)
+        end = len(data) if position == -1 else position
+        # trailing zeros belong to the next 4-byte start code
+        while end > begin and data[end - 1] == 0:
+            end -= 1
+        if end > begin:
+            units.append(view[begin:end])
+    return units
+
+
+class _BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def bit(self):
+        value = (self.data[self.position >> 3] >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bit():
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def sps_dimensions(sps):
+    reader = _BitReader(re.sub(b'\x00\x00\x03', b'\x00\x00', bytes(sps[1:])))
+    profile = reader.bits(8)
+    reader.bits(16)
+    reader.ue()
+    
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = reader.ue()
+        if chroma_format == 3:
+            reader.bit()
+        reader.ue()
+        reader.ue()
+        reader.bit()
+        if reader.bit():
+            for k in range(12 if chroma_format == 3 else 8):
+                if reader.bit():
+                    last = following = 8
+                    for _ in range(16 if k < 6 else 64):
+                        if following:
+                            following = (last + reader.se()) % 256
+                        last = following or last
+    
+    reader.ue()
+    order_type = reader.ue()
+    if order_type == 0:
+        reader.ue()
+    elif order_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()
+    reader.bit()
+    width_mbs = reader.ue() + 1
+    height_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    if not frame_mbs_only:
+        reader.bit()
+    reader.bit()
+    
+    crop = (0, 0, 0, 0)
+    if reader.bit():
+        crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+    crop_x = 1 if chroma_format in (0, 3) else 2
+    crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+    width = width_mbs * 16 - crop_x * (crop[0] + crop[1])
+    height = (2 - frame_mbs_only) * height_units * 16 - crop_y * (crop[2] + crop[3])
+    return width, height
+
+
+class _Track:
+    def __init__(self, pid, kind, track_id):
+        self.pid = pid
+        self.kind = kind
+        self.track_id = track_id
+        self.timescale = 90000
+        self.config = None
+        self.width = 0
+        self.height = 0
+        self.channels = 0
+        self.sps = None
+        self.pps = None
+        self.pes = None
+        self.samples = []
+        self.decode_time = None
+        self.last_duration = 3000
+
+
+class TSRemuxer:
+    # demuxes MPEG-TS as it is written and emits fragmented MP4 (one fragment
+    # per video GOP) so the .ts never has to be read back; H.264 video and
+    # ADTS AAC audio are supported, anything else makes the remux give up
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.carry = b''
+        self.pmt_pid = None
+        self.tracks = {}
+        self.header_written = False
+        self.base = None
+        self.sequence = 0
+        self.fragments = []
+        self.error = None
+        self.last_timestamp = None
+        self.wrap = 0
+
+    def write(self, data):
+        if self.error:
+            return
+        try:
+            self._feed(data)
+        except Exception as e:
+            self.abort(e)
+
+    def _feed(self, data):
+        view = memoryview(data)
+        start = 0
+        if self.carry:
+            start = TS_PACKET_SIZE - len(self.carry)
+            self.carry += bytes(view[:start])
+            if len(self.carry) < TS_PACKET_SIZE:
+                return
+            self._packet(memoryview(self.carry))
+            self.carry = b''
+        
+        end = start + (len(view) - start) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        for offset in range(start, end, TS_PACKET_SIZE):
+            self._packet(view[offset:offset + TS_PACKET_SIZE])
+        self.carry = bytes(view[end:])
+
+    def _packet(self, packet):
+        if packet[0] != 0x47:
+            raise ValueError("lost MPEG-TS sync")
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        unit_start = packet[1] & 0x40
+        adaptation = (packet[3] >> 4) & 0x03
+        if not adaptation & 0x01:
+            return
+        offset = 4 + (1 + packet[4] if adaptation & 0x02 else 0)
+        if offset >= TS_PACKET_SIZE:
+            return
+        payload = packet[offset:]
+        
+        if pid == 0:
+            if unit_start:
+                self._pat(payload)
+        elif pid == self.pmt_pid:
+            if unit_start:
+                self._pmt(payload)
+        elif pid in self.tracks:
+            track = self.tracks[pid]
+            if unit_start:
+                self._finish_pes(track)
+                track.pes = [payload]
+            elif track.pes is not None:
+                track.pes.append(payload)
+
+    def _section(self, payload):
+        table = payload[1 + payload[0]:]
+        length = ((table[1] & 0x0f) << 8) | table[2]
+        return table, 3 + length - 4
+
+    def _pat(self, payload):
+        table, end = self._section(payload)
+        for i in range(8, end, 4):
+            if (table[i] << 8) | table[i + 1]:
+                self.pmt_pid = ((table[i + 2] & 0x1f) << 8) | table[i + 3]
+                return
+
+    def _pmt(self, payload):
+        table, end = self._section(payload)
+        i = 12 + (((table[10] & 0x0f) << 8) | table[11])
+        while i + 5 <= end:
+            stream_type = table[i]
+            pid = ((table[i + 1] & 0x1f) << 8) | table[i + 2]
+            i += 5 + (((table[i + 3] & 0x0f) << 8) | table[i + 4])
+            if pid in self.tracks:
+                continue
+            if stream_type in UNSUPPORTED_STREAM_TYPES:
+                raise ValueError(f"{UNSUPPORTED_STREAM_TYPES[stream_type]} streams cannot be remuxed")
+            if stream_type in STREAM_TYPES:
+                if self.header_written:
+                    raise ValueError("a stream appeared after the MP4 header was written")
+                self.tracks[pid] = _Track(pid, STREAM_TYPES[stream_type], len(self.tracks) + 1)
+
+    def _unwrap(self, value):
+        # PTS/DTS are 33-bit and wrap roughly every 26.5 hours
+        value += self.wrap
+        if self.last_timestamp is not None and value < self.last_timestamp - (1 << 32):
+            self.wrap += 1 << 33
+            value += 1 << 33
+        self.last_timestamp = value
+        return value
+
+    def _finish_pes(self, track):
+        if not track.pes:
+            return
+        data = b''.join(track.pes)
+        track.pes = None
+        if data[:3] != b'\x00\x00\x01' or len(data) < 9:
+            return
+        
+        flags = data[7]
+        if not flags & 0x80:
+            return
+        pts = self._unwrap(_pes_timestamp(data[9:14]))
+        dts = self._unwrap(_pes_timestamp(data[14:19])) if flags & 0x40 else pts
+        payload_start = 9 + data[8]
+        
+        if track.kind == 'video':
+            self._video(track, data[payload_start:], pts, dts)
+        else:
+            self._audio(track, memoryview(data)[payload_start:], pts)
+
+    def _video(self, track, data, pts, dts):
+        parts = []
+        size = 0
+        key = False
+        for unit in split_annexb(data):
+            kind = unit[0] & 0x1f
+            if kind == 7:
+                track.sps = bytes(unit)
+            elif kind == 8:
+                track.pps = bytes(unit)
+            elif kind != 9:
+                key = key or kind == 5
+                parts.append(struct.pack('>I', len(unit)))
+                parts.append(unit)
+                size += 4 + len(unit)
+        
+        if track.config is None and track.sps and track.pps:
+            track.width, track.height = sps_dimensions(track.sps)
+            track.config = mp4_box(
+                b'avcC',
+                bytes([1, track.sps[1], track.sps[2], track.sps[3], 0xff, 0xe1]),
+                struct.pack('>H', len(track.sps)), track.sps,
+                b'\x01', struct.pack('>H', len(track.pps)), track.pps
+            )
+        
+        # nothing is decodable before the first keyframe with its parameter sets
+        if not parts or track.config is None or (not track.samples and track.decode_time is None and not key):
+            return
+        
+        if key and self.header_written and any(t.samples for t in self.tracks.values()):
+            self._write_fragment(dts)
+        track.samples.append((dts, pts - dts, parts, size, key))
+        self._maybe_start()
+
+    def _audio(self, track, data, pts):
+        i = 0
+        frame = 0
+        while i + 7 <= len(data):
+            if data[i] != 0xff or data[i + 1] & 0xf0 != 0xf0:
+                break
+            header = 7 if data[i + 1] & 0x01 else 9
+            length = ((data[i + 3] & 0x03) << 11) | (data[i + 4] << 3) | (data[i + 5] >> 5)
+            if length < header or i + length > len(data):
+                break
+            
+            if track.config is None:
+                profile = (data[i + 2] >> 6) & 0x03
+                rate_index = (data[i + 2] >> 2) & 0x0f
+                track.channels = ((data[i + 2] & 0x01) << 2) | (data[i + 3] >> 6)
+                track.timescale = ADTS_SAMPLE_RATES[rate_index]
+                track.config = struct.pack('>H', ((profile + 1) << 11) | (rate_index << 7) | (track.channels << 3))
+            
+            body = data[i + header:i + length]
+            track.samples.append((pts + frame * 1024 * 90000 // track.timescale, 0, [body], len(body), True))
+            frame += 1
+            i += length
+        
+        video = any(t.kind == 'video' for t in self.tracks.values())
+        if not video and self.header_written and len(track.samples) >= 2 * track.timescale // 1024:
+            self._write_fragment()
+        self._maybe_start()
+
+    def _maybe_start(self):
+        if self.header_written or not self.tracks or any(t.config is None for t in self.tracks.values()):
+            return
+        self._write_header()
+
+    def _write_header(self):
+        tracks = [t for t in self.tracks.values() if t.config is not None]
+        firsts = [t.samples[0][0] for t in tracks if t.samples]
+        self.base = min(firsts) if firsts else 0
+        
+        traks = [self._trak(t) for t in tracks]
+        mvex = mp4_box(b'mvex', *(mp4_full_box(b'trex', 0, 0, struct.pack('>5I', t.track_id, 1, 0, 0, 0)) for t in tracks))
+        mvhd = mp4_full_box(
+            b'mvhd', 0, 0,
+            struct.pack('>5I', 0, 0, 1000, 0, 0x00010000), struct.pack('>H', 0x0100), b'\x00' * 10,
+            IDENTITY_MATRIX, b'\x00' * 24, struct.pack('>I', len(self.tracks) + 1)
+        )
+        self.file.write(mp4_box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isomiso6avc1mp41'))
+        self.file.write(mp4_box(b'moov', mvhd, *traks, mvex))
+        self.header_written = True
+
+    def _trak(self, track):
+        video = track.kind == 'video'
+        tkhd = mp4_full_box(
+            b'tkhd', 0, 0x03,
+            struct.pack('>5I', 0, 0, track.track_id, 0, 0), b'\x00' * 8,
+            struct.pack('>hhHH', 0, 0, 0 if video else 0x0100, 0), IDENTITY_MATRIX,
+            struct.pack('>II', track.width << 16, track.height << 16)
+        )
+        mdhd = mp4_full_box(b'mdhd', 0, 0, struct.pack('>4I', 0, 0, track.timescale, 0), struct.pack('>HH', 0x55c4, 0))
+        hdlr = mp4_full_box(b'hdlr', 0, 0, b'\x00' * 4, b'vide' if video else b'soun', b'\x00' * 12, b'VideoHandler\x00' if video else b'SoundHandler\x00')
+        media_header = mp4_full_box(b'vmhd', 0, 1, b'\x00' * 8) if video else mp4_full_box(b'smhd', 0, 0, b'\x00' * 4)
+        dinf = mp4_box(b'dinf', mp4_full_box(b'dref', 0, 0, struct.pack('>I', 1), mp4_full_box(b'url ', 0, 1)))
+        
+        if video:
+            entry = mp4_box(
+                b'avc1', b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 16,
+                struct.pack('>HHIIIH', track.width, track.height, 0x00480000, 0x00480000, 0, 1),
+                b'\x00' * 32, struct.pack('>Hh', 0x0018, -1), track.config
+            )
+        else:
+            esds = mp4_full_box(b'esds', 0, 0, _descriptor(
+                0x03, struct.pack('>HB', track.track_id, 0),
+                _descriptor(0x04, bytes([0x40, 0x15]), b'\x00' * 11, _descriptor(0x05, track.config)),
+                _descriptor(0x06, b'\x02')
+            ))
+            entry = mp4_box(
+                b'mp4a', b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 8,
+                struct.pack('>HHHHI', track.channels, 16, 0, 0, track.timescale << 16), esds
+            )
+        
+        stbl = mp4_box(
+            b'stbl',
+            mp4_full_box(b'stsd', 0, 0, struct.pack('>I', 1), entry),
+            mp4_full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+            mp4_full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+            mp4_full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+            mp4_full_box(b'stco', 0, 0, struct.pack('>I', 0))
+        )
+        minf = mp4_box(b'minf', media_header, dinf, stbl)
+        return mp4_box(b'trak', tkhd, mp4_box(b'mdia', mdhd, hdlr, minf))
+
+    def _write_fragment(self, video_end=None):
+        tracks = [t for t in self.tracks.values() if t.samples and t.config is not None]
+        if not tracks:
+            return
+        self.sequence += 1
+        
+        runs = []
+        for track in tracks:
+            scale = track.timescale / 90000
+            if track.decode_time is None:
+                track.decode_time = max(0, round((track.samples[0][0] - self.base) * scale))
+            entries = []
+            for k, (dts, offset, _, size, key) in enumerate(track.samples):
+                if track.kind == 'audio':
+                    duration = 1024
+                else:
+                    following = track.samples[k + 1][0] if k + 1 < len(track.samples) else video_end
+                    duration = round((following - dts) * scale) if following is not None else track.last_duration
+                    track.last_duration = duration
+                flags = 0x02000000 if key else 0x01010000
+                entries.append(struct.pack('>IIIi', duration, size, flags, round(offset * scale)))
+            runs.append((track, entries))
+        
+        def moof(offsets):
+            trafs = []
+            for (track, entries), data_offset in zip(runs, offsets):
+                trafs.append(mp4_box(
+                    b'traf',
+                    mp4_full_box(b'tfhd', 0, 0x020000, struct.pack('>I', track.track_id)),
+                    mp4_full_box(b'tfdt', 1, 0, struct.pack('>Q', track.decode_time)),
+                    mp4_full_box(b'trun', 1, 0x000f01, struct.pack('>Ii', len(entries), data_offset), *entries)
+                ))
+            return mp4_box(b'moof', mp4_full_box(b'mfhd', 0, 0, struct.pack('>I', self.sequence)), *trafs)
+        
+        # data offsets are relative to the start of moof, whose size does not
+        # depend on their values
+        moof_size = len(moof([0] * len(runs)))
+        offsets = []
+        position = moof_size + 8
+        for track, _ in runs:
+            offsets.append(position)
+            position += sum(sample[3] for sample in track.samples)
+        
+        self.fragments.append((runs[0][0].track_id, runs[0][0].decode_time, self.file.tell()))
+        self.file.write(moof(offsets))
+        self.file.write(struct.pack('>I4s', position - moof_size, b'mdat'))
+        for track, entries in runs:
+            for sample in track.samples:
+                self.file.writelines(sample[2])
+            track.decode_time += sum(struct.unpack('>I', entry[:4])[0] for entry in entries)
+            track.samples = []
+
+    def close(self):
+        # returns True when a playable MP4 was written
+        if self.error:
+            return False
+        try:
+            for track in self.tracks.values():
+                self._finish_pes(track)
+            if not self.header_written:
+                if not any(t.config for t in self.tracks.values()):
+                    raise ValueError("no H.264 or AAC stream found")
+                self._write_header()
+            self._write_fragment()
+            
+            # a random-access index at the end lets players seek without
+            # walking every fragment
+            by_track = {}
+            for track_id, decode_time, offset in self.fragments:
+                by_track.setdefault(track_id, []).append((decode_time, offset))
+            tfras = [
+                mp4_full_box(b'tfra', 1, 0, struct.pack('>III', track_id, 0, len(entries)),
+                             *(struct.pack('>QQBBB', t, o, 1, 1, 1) for t, o in entries))
+                for track_id, entries in by_track.items()
+            ]
+            mfra_body = b''.join(tfras)
+            self.file.write(mp4_box(b'mfra', mfra_body, mp4_full_box(b'mfro', 0, 0, struct.pack('>I', 8 + len(mfra_body) + 16))))
+            self.file.close()
+            return True
+        except Exception as e:
+            self.abort(e)
+            return False
+
+    def abort(self, error=None):
+        self.error = error or self.error or ValueError("remux aborted")
+        try:
+            self.file.close()
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class WatchServer(ThreadingHTTPServer):
+    # serves a download in progress to a local player, either as an HLS
+    # playlist of the segments or as one growing MPEG-TS stream; every
+    # request moves the playhead the scheduler fetches ahead of
+    daemon_threads = True
+    
+    def __init__(self, port, playlist, segments, writer, wait=60.0):
+        super().__init__(('127.0.0.1', port), _WatchHandler)
+        self.playlist = playlist
+        self.segments = segments
+        self.writer = writer
+        self.wait = wait
+        # index of the segment the player asked for last; None until it
+        # asks for anything
+        self.playhead = None
+        self.active = 0
+        self.last_request = time.time()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+    
+    def start(self):
+        self.thread.start()
+        print(f"Watch at {self.url}/index.m3u8 (or {self.url}/stream.ts)")
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    
+    def linger(self, idle=60.0):
+        # keep serving the finished download until the player has been quiet
+        # for a while; Ctrl+C stops waiting
+        print(f"Still serving at {self.url}/index.m3u8 (Ctrl+C to stop)")
+        try:
+            while self.active or time.time() - self.last_request < idle:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+    
+    def render_playlist(self):
+        offset = 1 if self.playlist.init_section else 0
+        target = self.playlist.target_duration or max((s['duration'] or 0 for s in self.segments[offset:]), default=10)
+        lines = [
+            '#EXTM3U',
+            f"#EXT-X-VERSION:{6 if offset else 3}",
+            f"#EXT-X-TARGETDURATION:{int(-(-target // 1))}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.playlist.media_sequence}",
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+        ]
+        if offset:
+            lines.append('#EXT-X-MAP:URI="/seg/0.ts"')
+        # segments are decrypted before they are stored, so no EXT-X-KEY
+        for i, segment in enumerate(self.segments[offset:], offset):
+            lines.append(f"#EXTINF:{segment['duration'] or 0:.3f},")
+            lines.append(f"/seg/{i}.ts")
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class _WatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        server = self.server
+        server.active += 1
+        server.last_request = time.time()
+        try:
+            path = urlparse(self.path).path
+            match = re.fullmatch(r'/seg/(\d+)\.ts', path)
+            if path == '/index.m3u8':
+                self._send(200, server.render_playlist(), 'application/vnd.apple.mpegurl')
+            elif match and int(match.group(1)) < len(server.segments):
+                i = int(match.group(1))
+                if server.segments[i]['sequence'] is not None:
+                    server.playhead = i
+                content = server.writer.read(i, timeout=server.wait)
+                if content is None:
+                    self._send(504 if i not in server.writer.skipped else 404, b'', 'text/plain')
+                else:
+                    self._send(200, content, 'video/mp2t')
+            elif path == '/stream.ts':
+                self._stream()
+            else:
+                self._send(404, b'', 'text/plain')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            server.active -= 1
+            server.last_request = time.time()
+    
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _stream(self):
+        # the whole title in order, without a length; segments that were
+        # given up on are left out
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for i in range(len(server.segments)):
+            server.playhead = i
+            content = server.writer.read(i, timeout=server.wait)
+            if content is None and i not in server.writer.skipped:
+                return
+            if content:
+                self.wfile.write(content)
+            server.last_request = time.time()
+
+
+def playlist_fingerprint(segments):
+    # identifies the segment layout a journal was written against
+    return hashlib.sha1('\n'.join(
+        segment['uri'] + (f"@{segment['byterange'][0]}+{segment['byterange'][1]}" if segment['byterange'] else '') for segment in segments
+    ).encode('utf-8')).hexdigest()
+
+
+def segment_sizes(segments, session, max_workers=20):
+    # byte ranges carry their size; plain segments are asked with HEAD, or
+    # with a one-byte Range request where HEAD is not answered
+    def size(segment):
+        if segment['byterange']:
+            return segment['byterange'][1]
+        try:
+            response = session.head(segment['uri'], timeout=10, allow_redirects=True)
+            length = response.headers.get('Content-Length', '')
+            if response.ok and length.isdigit() and not response.headers.get('Content-Encoding'):
+                return int(length)
+            with session.get(segment['uri'], timeout=10, headers=range_header((0, 1)), stream=True) as response:
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                return int(total) if response.status_code == 206 and total.isdigit() else None
+        except Exception:
+            return None
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(size, segments))
+
+
+def check_download(m3u8_file, output_file, base_url=DEFAULT_BASE_URL, max_workers=20):
+    # validates every segment already in output_file and rewrites the journal
+    # to list only the good ones, so a resumed download re-fetches just the
+    # bad and missing indices; returns those indices
+    with open(m3u8_file, 'r', encoding='utf-8') as f:
+        playlist = HLSPlaylist.parse(f.read(), base_url)
+    segments = ([playlist.init_section] if playlist.init_section else []) + playlist.segments
+    mpegts = playlist.init_section is None
+    journal = SegmentJournal(output_file + '.journal', playlist_fingerprint(segments))
+    
+    entries = journal.load()
+    if not entries and any(segment['key'] for segment in segments):
+        # padding is stripped when decrypting, so the sizes the origin reports
+        # are not the sizes on disk
+        print(f"No journal for {os.path.basename(output_file)}; an encrypted title is re-fetched in full without one")
+    elif not entries:
+        # no journal (the download finished, or predates journals): segments
+        # were written back to back, so their sizes give the offsets
+        print(f"No journal for {os.path.basename(output_file)}; asking the origin for segment sizes")
+        session = create_session(pool_connections=max_workers, pool_maxsize=max_workers)
+        sizes = segment_sizes(segments, session, max_workers)
+        session.close()
+        offset = 0
+        for i, size in enumerate(sizes):
+            if size is None:
+                print(f"✗ Could not get the size of segment {i}; segments from there on are re-fetched")
+                break
+            entries[i] = (offset, size)
+            offset += size
+    
+    file_size = os.path.getsize(output_file)
+    good = {}
+    corrupt = []
+    with open(output_file, 'rb') as f:
+        for i, (offset, size) in sorted(entries.items()):
+            if offset + size > file_size:
+                continue
+            f.seek(offset)
+            problem = validate_segment(f.read(size), segments[i], mpegts)
+            if problem:
+                print(f"Segment {i}: {problem}")
+                corrupt.append(i)
+            else:
+                good[i] = (offset, size)
+    
+    journal.open(good)
+    journal.close()
+    
+    bad = [i for i in range(len(segments)) if i not in good]
+    print(f"Checked {len(entries)} segments: {len(corrupt)} corrupt, {len(bad) - len(corrupt)} missing")
+    return bad
+
+
+# per-download settings; job_settings builds them from the command line and
+# download_m3u8_video fills in whatever a caller leaves out
+DOWNLOAD_DEFAULTS = {
+    'max_workers': 20,
+    'engine': 'thread',
+    'adaptive': False,
+    'reorder_window': None,
+    'resume': False,
+    'max_attempts': 5,
+    'hedge': True,
+    'remux': False,
+    'watch': None,
+    'job_rate': None,
+    'priority': 'normal',
+    'validate': True,
+    'keep_ts': False,
+}
+
+
+class SegmentScheduler:
+    # runs the fetches of one download: what goes next (in order, or around
+    # a player's playhead), which mirror serves it, hedged duplicates,
+    # retries with backoff and the decrypt stage. Every finished fetch or
+    # decryption ends in fetched(), decrypted(), failed() or stored()
+    def __init__(self, units, sources, writer, fetcher, settings, selector=None, decryptor=None, server=None, shaper=None, mpegts=True, progress=None):
+        self.units = units
+        self.sources = sources
+        self.segments = sources[0]
+        self.writer = writer
+        self.fetcher = fetcher
+        self.settings = settings
+        self.selector = selector
+        self.decryptor = decryptor
+        self.server = server
+        self.shaper = shaper
+        self.mpegts = mpegts
+        self.progress = progress
+        
+        max_workers = settings['max_workers']
+        # max_workers sizes the pool and acts as the ceiling when adaptive
+        self.controller = ConcurrencyController(max(2, max_workers // 4), maximum=max_workers) if settings['adaptive'] else None
+        # hedging duplicates stragglers; the first copy to answer wins
+        self.hedger = HedgePolicy(budget=max(4, len(units) // 20)) if settings['hedge'] else None
+        # per-host stats go by the mirror a fetch went to
+        self.hosts = [urlparse(source[0]['uri']).netloc or 'local' for source in sources]
+        
+        # fetch future -> (unit, submitted, mirror, is_hedge)
+        self.in_flight = {}
+        # units fetched and waiting on the decryptor: future -> (unit, bytes)
+        self.decrypting = {}
+        self.copies = {}
+        self.hedged = set()
+        self.last_mirror = {}
+        self.retry_queue = []
+        self.failures = {}
+        # throttled answers an adaptive download would once have had retried
+        # by the transport; they do not use up the unit's attempts
+        self.throttled = {}
+        self.sent = set()
+        # first unsubmitted unit overall, and first unsubmitted unit at or
+        # after the player's position
+        self.next_submit = 0
+        self.ahead = 0
+        self.playhead = None
+        self.starts = [unit['indices'][0] for unit in units]
+        
+        self.total = sum(len(unit['indices']) for unit in units)
+        self.completed = 0
+        self.total_bytes = 0
+        self.retries = 0
+        self.retry_success = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.invalid = 0
+        self.start_time = time.time()
+        self.last_print_time = self.start_time
+
+    def run(self):
+        while self.completed < self.total:
+            limit = self.controller.limit if self.controller else self.settings['max_workers']
+            while len(self.in_flight) < limit:
+                if self.retry_queue and self.retry_queue[0][0] <= time.time():
+                    i = heapq.heappop(self.retry_queue)[1]
+                else:
+                    i = self.next_unit()
+                    if i is None:
+                        break
+                # a retry goes to a different mirror than the one that failed
+                self.submit(i, exclude=self.last_mirror.get(i) if i in self.failures else None)
+            
+            threshold = self.hedge(limit)
+            timeout = self.timeout(threshold)
+            if not self.in_flight and not self.decrypting:
+                time.sleep(timeout or 0)
+                continue
+            done, _ = wait(list(self.in_flight) + list(self.decrypting), timeout=timeout, return_when=FIRST_COMPLETED)
+            
+            for future in done:
+                if future in self.decrypting:
+                    self.decrypted(future)
+                elif future in self.in_flight:
+                    self.fetched(future)
+                # anything else is the losing copy of a hedged fetch, already
+                # written off
+
+    def next_unit(self):
+        # with a player attached, the units just ahead of its playhead come
+        # first and a seek moves them; otherwise units go in order, as far
+        # as the reorder window allows
+        if self.server and self.server.playhead != self.playhead:
+            self.playhead = self.server.playhead
+            self.ahead = max(0, bisect.bisect_right(self.starts, self.playhead) - 1)
+        while self.ahead < len(self.units) and self.ahead in self.sent:
+            self.ahead += 1
+        while self.next_submit < len(self.units) and self.next_submit in self.sent:
+            self.next_submit += 1
+        if self.playhead is not None and self.ahead < len(self.units):
+            return self.ahead
+        if self.next_submit < len(self.units) and self.writer.can_accept(self.starts[self.next_submit]):
+            return self.next_submit
+        return None
+
+    def submit(self, i, exclude=None, is_hedge=False):
+        unit = self.units[i]
+        mirror, request = 0, (unit['uri'], unit['byterange'])
+        if self.selector:
+            mirror = self.selector.choose(
+                exclude=exclude,
+                usable=lambda m: unit_request(unit, self.sources[m]) is not None
+            )
+            request = unit_request(unit, self.sources[mirror])
+        self.last_mirror[i] = mirror
+        future = self.fetcher.submit(i, *request, shaper=self.shaper)
+        self.sent.add(i)
+        self.in_flight[future] = (i, time.time(), mirror, is_hedge)
+        self.copies.setdefault(i, []).append(future)
+
+    def hedge(self, limit):
+        # stragglers past the latency percentile get a duplicate even when
+        # every slot is busy; once nothing new is left to submit, idle slots
+        # also duplicate fetches past the tail percentile. Both draw on the
+        # budget. Returns the threshold now in force
+        if not self.hedger:
+            return None
+        tail = len(self.sent) == len(self.units) and not self.retry_queue
+        
+        def thresholds():
+            straggler = self.hedger.threshold()
+            speculative = self.hedger.threshold(self.hedger.tail_percentile) if tail and len(self.in_flight) < limit else None
+            return straggler, speculative
+        
+        threshold, tail_threshold = thresholds()
+        now = time.time()
+        for i, submitted, mirror, _ in sorted(self.in_flight.values(), key=lambda entry: entry[1]):
+            if threshold is None:
+                break
+            if i in self.hedged:
+                continue
+            late = now - submitted
+            if late <= threshold and (tail_threshold is None or late <= tail_threshold):
+                continue
+            self.hedger.budget -= 1
+            self.hedged.add(i)
+            self.hedges += 1
+            metrics.count('hedges')
+            self.submit(i, exclude=mirror, is_hedge=True)
+            threshold, tail_threshold = thresholds()
+        return threshold if tail_threshold is None else min(threshold, tail_threshold)
+
+    def timeout(self, threshold):
+        # wake up for whichever comes first: a finished fetch, the next retry
+        # coming off its backoff or the oldest fetch turning into a straggler
+        deadlines = [self.retry_queue[0][0]] if self.retry_queue else []
+        unhedged = [submitted for i, submitted, _, _ in self.in_flight.values() if i not in self.hedged]
+        if threshold is not None and unhedged:
+            deadlines.append(min(unhedged) + threshold)
+        if self.server:
+            # look at the playhead again soon in case the player seeked
+            deadlines.append(time.time() + 0.25)
+        return max(0, min(deadlines) - time.time()) if deadlines else None
+
+    def check(self, unit, pieces, decrypted=True):
+        # the first piece that cannot be its segment, as an error; encrypted
+        # pieces are only checked once they have been decrypted
+        if not self.settings['validate']:
+            return None
+        for index, piece in zip(unit['indices'], pieces):
+            if self.segments[index]['key'] and not decrypted:
+                continue
+            problem = validate_segment(piece, self.segments[index], self.mpegts)
+            if problem:
+                self.invalid += 1
+                metrics.count('invalid')
+                return IOError(f"segment {index} failed validation: {problem}")
+        return None
+
+    def fetched(self, future):
+        i, submitted, mirror, is_hedge = self.in_flight.pop(future)
+        self.copies[i].remove(future)
+        _, content, error = future.result()
+        unit = self.units[i]
+        nbytes = len(content) if content else 0
+        
+        pieces = None
+        if not error:
+            try:
+                pieces = split_unit(unit, content)
+            except IOError as e:
+                error = e
+        if not error:
+            # a bad body goes back into the queue like a failed fetch
+            error = self.check(unit, pieces, decrypted=False)
+        
+        latency = time.time() - submitted
+        metrics.fetch(self.hosts[mirror], submitted, nbytes, error, is_hedge)
+        if self.selector:
+            self.selector.record(mirror, latency, nbytes, error)
+        if self.controller:
+            self.controller.record(latency, bool(error) and is_throttle_error(error))
+        if self.hedger and not error:
+            self.hedger.record(latency)
+        
+        if error and self.copies[i]:
+            # the other copy of this unit is still running
+            return
+        for other in self.copies.pop(i):
+            other.cancel()
+            if self.selector:
+                self.selector.release(self.in_flight[other][2])
+            del self.in_flight[other]
+        if is_hedge and not error:
+            self.hedge_wins += 1
+        
+        if error:
+            self.failed(i, error)
+        elif self.decryptor and any(self.segments[index]['key'] for index in unit['indices']):
+            # decrypted off this thread with the keys of the mirror it came
+            # from; the unit is finished when that is
+            segments = [self.sources[mirror][index] for index in unit['indices']]
+            self.decrypting[self.decryptor.submit(segments, pieces)] = (i, nbytes)
+        else:
+            self.stored(i, pieces, nbytes)
+
+    def decrypted(self, future):
+        i, nbytes = self.decrypting.pop(future)
+        error = future.exception()
+        if error:
+            metrics.count('decrypt_failures')
+            self.failed(i, error)
+            return
+        pieces = future.result()
+        error = self.check(self.units[i], pieces)
+        if error:
+            self.failed(i, error)
+        else:
+            self.stored(i, pieces, nbytes)
+
+    def failed(self, i, error):
+        # back into the queue after a backoff, or given up on once the unit
+        # is out of attempts
+        if self.controller and is_throttle_error(error) and self.throttled.get(i, 0) < STATUS_RETRIES:
+            self.throttled[i] = self.throttled.get(i, 0) + 1
+            self.failures.setdefault(i, 0)
+            self._retry(i, self.throttled[i])
+            return
+        self.failures[i] = self.failures.get(i, 0) + 1
+        if self.failures[i] < self.settings['max_attempts']:
+            self._retry(i, self.failures[i])
+            return
+        unit = self.units[i]
+        for index in unit['indices']:
+            self.writer.skip(index)
+        metrics.count('segments_failed', len(unit['indices']))
+        self._finish(unit)
+
+    def _retry(self, i, attempt):
+        heapq.heappush(self.retry_queue, (time.time() + retry_delay(attempt), i))
+        self.retries += 1
+        metrics.count('retries')
+
+    def stored(self, i, pieces, nbytes):
+        unit = self.units[i]
+        if i in self.failures:
+            self.retry_success += 1
+        self.total_bytes += nbytes
+        # includes any remuxing and journal writes behind the file
+        write_start = time.time()
+        for index, piece in zip(unit['indices'], pieces):
+            self.writer.add(index, piece)
+        metrics.observe('write', time.time() - write_start)
+        metrics.count('segments', len(unit['indices']))
+        metrics.count('bytes', nbytes)
+        self._finish(unit)
+
+    def _finish(self, unit):
+        self.completed += len(unit['indices'])
+        completed, total = self.completed, self.total
+        if self.progress:
+            self.progress(completed, total, self.total_bytes)
+        
+        current_time = time.time()
+        if current_time - self.last_print_time >= 0.5 or completed % 20 == 0 or completed == total:
+            elapsed = current_time - self.start_time
+            rate = completed / elapsed if elapsed > 0 else 0
+            percent = (completed / total) * 100
+            speed_mbps = (self.total_bytes * 8) / (elapsed * 1_000_000) if elapsed > 0 else 0
+            
+            bar_length = 40
+            filled_length = int(bar_length * completed // total)
+            bar = '█' * filled_length + '-' * (bar_length - filled_length)
+            
+            workers = f" | x{self.controller.limit}" if self.controller else ''
+            print(f"\r|{bar}| {percent:.1f}% | {rate:.1f}/s | {speed_mbps:.2f}Mbps | {completed}/{total}{workers}", end='', flush=True)
+            
+            self.last_print_time = current_time
+
+    def summary(self):
+        if self.failures:
+            print(f"Retry successful: {self.retry_success}/{len(self.failures)} ({self.retries} retries)")
+        
+        if self.invalid:
+            print(f"Rejected {self.invalid} invalid segment responses")
+        
+        if self.hedges:
+            print(f"Hedged: {self.hedges} duplicate fetches, {self.hedge_wins} finished first")
+        
+        if self.selector:
+            print("Mirrors: " + ', '.join(
+                f"{urlparse(source[0]['uri']).netloc} {stats['served']}" for source, stats in zip(self.sources, self.selector.stats)
+            ))
+
+
+def download_m3u8_video(m3u8_file, output_file, max_workers=None, base_url=DEFAULT_BASE_URL, settings=None, fetcher=None, mirrors=(), bandwidth=None, progress=None):
+    # max_workers and base_url keep their original positions; everything
+    # newer travels in settings
+    settings = dict(DOWNLOAD_DEFAULTS, **(settings or {}))
+    if max_workers is not None:
+        settings['max_workers'] = max_workers
+    max_workers = settings['max_workers']
+    if not os.path.exists(m3u8_file):
+        print(f"✗ M3U8 file not found: {m3u8_file}")
+        return False
+    
+    with open(m3u8_file, 'r', encoding='utf-8') as f:
+        # URIs in saved playlists are absolute; older or hand-made ones are
+        # resolved against base_url
+        playlist = HLSPlaylist.parse(f.read(), base_url)
+    
+    segments = ([playlist.init_section] if playlist.init_section else []) + playlist.segments
+    
+    if not segments:
+        print("✗ No segment URLs found in the m3u8 file.")
+        return False
+    
+    sources = [segments]
+    primary_size = probe_mirror(playlist.segments[0]) if mirrors and playlist.segments else None
+    for mirror_file in mirrors:
+        try:
+            with open(mirror_file, 'r', encoding='utf-8') as f:
+                mirror = HLSPlaylist.parse(f.read(), base_url)
+        except OSError:
+            continue
+        mirror_segments = ([mirror.init_section] if mirror.init_section else []) + mirror.segments
+        if not playlists_equivalent(segments, mirror_segments):
+            print(f"Skipping mirror {urlparse(mirror_segments[0]['uri']).netloc if mirror_segments else mirror_file}: segments differ")
+            continue
+        if any(source[0]['uri'] == mirror_segments[0]['uri'] for source in sources):
+            continue
+        size = probe_mirror(mirror.segments[0])
+        if size is None:
+            print(f"Skipping mirror {urlparse(mirror_segments[0]['uri']).netloc}: not responding")
+            continue
+        if not size or size != primary_size:
+            # same durations but another size is another rendition; without
+            # sizes on both sides that cannot be ruled out
+            print(f"Skipping mirror {urlparse(mirror_segments[0]['uri']).netloc}: not the same rendition")
+            continue
+        sources.append(mirror_segments)
+    
+    selector = MirrorSelector(len(sources)) if len(sources) > 1 else None
+    if selector:
+        print(f"Using {len(sources)} mirrors: {', '.join(urlparse(source[0]['uri']).netloc for source in sources)}")
+    
+    methods = {segment['key']['method'] for source in sources for segment in source if segment['key']}
+    if methods - {'AES-128'}:
+        print(f"✗ Unsupported encryption: {', '.join(sorted(methods - {'AES-128'}))}")
+        return False
+    decryptor = None
+    if methods:
+        try:
+            decryptor = SegmentDecryptor()
+        except ImportError:
+            print("✗ This title is encrypted; decrypting it requires cryptography (pip install cryptography)")
+            return False
+        print("Encrypted playlist: decrypting AES-128 segments as they arrive")
     
+    reorder_window = settings['reorder_window']
+    if reorder_window is None:
+        reorder_window = max_workers * 2
+    
+    # a fetcher passed in by the caller is shared across jobs and stays open
+    owns_fetcher = fetcher is None
+    if owns_fetcher:
+        fetcher = create_engine(settings['engine'], max_workers, settings['adaptive'])
+        if fetcher is None:
+            return False
+    
+    journal = SegmentJournal(output_file + '.journal', playlist_fingerprint(segments))
+    # the MP4 is built while segments are written, not from the .ts afterwards
+    remuxer = TSRemuxer(os.path.splitext(output_file)[0] + '.mp4') if settings['remux'] else None
+    writer = SegmentWriter(output_file, max(reorder_window, max_workers), journal, settings['resume'], remuxer)
+    todo = [i for i in range(len(segments)) if not writer.is_done(i)]
+    # coalescing stops short of leaving workers idle: units are capped so
+    # there are still at least max_workers of them
+    ranged_bytes = sum(segments[i]['byterange'][1] for i in todo if segments[i]['byterange'])
+    units = coalesce_segments(todo, segments, min(8 * 1024 * 1024, max(1, ranged_bytes // max_workers)))
+    # the reorder window counts segments; with coalesced units it has to
+    # stretch to the same number of units or only a couple can be in flight
+    writer.window *= max((len(unit['indices']) for unit in units), default=1)
+    
+    if len(todo) < len(segments):
+        print(f"Resuming: {len(segments) - len(todo)}/{len(segments)} segments already on disk")
+    
+    server = None
+    if settings['watch'] is not None:
+        try:
+            server = WatchServer(settings['watch'], playlist, segments, writer)
+            server.start()
+        except OSError as e:
+            print(f"✗ Could not start watch server on port {settings['watch']}: {e}")
+    
+    # reads are only shaped when there is a global or a per-job cap
+    job_rate = settings['job_rate']
+    if bandwidth is None and job_rate:
+        bandwidth = BandwidthScheduler()
+    shaper = bandwidth.open(job_rate, settings['priority']) if bandwidth and (bandwidth.rate or job_rate) else None
+    
+    # fMP4 playlists announce an init section; anything else is MPEG-TS
+    scheduler = SegmentScheduler(
+        units, sources, writer, fetcher, settings, selector=selector, decryptor=decryptor,
+        server=server, shaper=shaper, mpegts=playlist.init_section is None, progress=progress
+    )
+    try:
+        scheduler.run()
+        if server:
+            print()
+            server.linger()
+    except BaseException:
+        if remuxer:
+            remuxer.abort()
+        raise
+    finally:
+        if server:
+            server.stop()
+        if shaper:
+            shaper.close()
+        if decryptor:
+            decryptor.close()
+        if owns_fetcher:
+            fetcher.close()
+        writer.close()
+    
+    print()
+    scheduler.summary()
+    
+    missing_count = writer.missing
+    if missing_count == 0:
+        journal.remove()
+    
+    if remuxer and missing_count:
+        remuxer.abort()
+    elif remuxer:
+        with metrics.span('remux'):
+            remuxed = remuxer.close()
+        if remuxed:
+            if not settings['keep_ts']:
+                os.remove(output_file)
+            output_file = remuxer.path
+        else:
+            print(f"Could not remux to MP4 ({remuxer.error}); keeping the MPEG-TS stream")
+    
+    total_time = time.time() - scheduler.start_time
+    total_mb = writer.bytes_written / (1024 * 1024)
+    avg_speed_mbps = (scheduler.total_bytes * 8) / (total_time * 1_000_000)
+    
+    print(f"Download Complete!")
+    print(f"File: {output_file}")
+    print(f"Size: {total_mb:.2f} MB")
+    print(f"Time: {total_time:.2f}s")
+    print(f"Speed: {avg_speed_mbps:.2f} Mbps")
+    
+    if missing_count > 0:
+        print(f"Warning: {missing_count} segments missing")
+        return False
+    
+    return True
+
+
+def parse_arguments(args):
     query_parts = []
     season = 1
-    episode = 1
+    episodes = [1]
     quality = '720p'
-    i = 0
+    options = {}
     
-    while i < len(args):
-        arg = args[i]
-        if arg.startswith('-s') and 'e' in arg:
-            match = re.search(r'-s(\d+)e(\d+)', arg, re.IGNORECASE)
+    for arg in args:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value if value else True
+        elif arg.startswith('-s'):
+            # -s01e02 is one episode, -s01e01-e10 a range and -s02 the whole season
+            match = re.match(r'-s(\d+)(?:e(\d+)(?:-e?(\d+))?)?$', arg, re.IGNORECASE)
             if match:
                 season = int(match.group(1))
-                episode = int(match.group(2))
-        elif arg.startswith('-') and not arg.startswith('-s'):
+                if match.group(2) is None:
+                    episodes = None
+                else:
+                    first = int(match.group(2))
+                    last = int(match.group(3)) if match.group(3) else first
+                    episodes = list(range(first, last + 1))
+        elif arg.startswith('-'):
             quality = arg[1:]
         else:
             query_parts.append(arg)
-        i += 1
     
     query = ' '.join(query_parts)
-    return query, season, episode, quality
+    return query, season, episodes, quality, options
 
 
-def main():
-    query, season, episode, quality = parse_command_line()
+def parse_command_line():
+    args = sys.argv[1:]
+    if not args:
+        return None, None, None, '720p', {}
+    return parse_arguments(args)
+
+
+def load_batch(path, quality='720p'):
+    # one title per line using the same syntax as the command line, e.g.
+    # "Breaking Bad" -s02 -1080p; blank lines and # comments are skipped
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            query, season, episodes, line_quality, _ = parse_arguments(['-' + quality] + shlex.split(line))
+            if query:
+                entries.append({'query': query, 'season': season, 'episodes': episodes, 'quality': line_quality})
+    return entries
+
+
+def find_saved_playlist(output_file):
+    segment_file = output_file.replace('.ts', '_segments.m3u8')
+    if os.path.exists(segment_file):
+        return segment_file
     
-    if not query:
-        print("Usage: python main.py <title> [-s01e01] [-360p]")
-        return
+    playlist_file = output_file.replace('.ts', '.m3u8')
+    if os.path.exists(playlist_file):
+        with open(playlist_file, 'r', encoding='utf-8') as f:
+            if 'EXT-X-STREAM-INF' not in f.read():
+                return playlist_file
+    return None
+
+
+def title_output_file(selected, season=None, episode=None):
+    safe_title = "".join(c for c in selected['title'] if c.isalnum() or c in (' ', '-', '_')).strip()
+    folder_path = os.path.join(os.getcwd(), safe_title)
+    os.makedirs(folder_path, exist_ok=True)
+    
+    if selected['type'] == 'tv':
+        return os.path.join(folder_path, f"{safe_title}_S{season:02d}E{episode:02d}.ts")
+    return os.path.join(folder_path, f"{safe_title}.ts")
+
+
+def prepare_playlist(capture, selected, output_file, quality, season=1, episode=1, resume=False, use_mirrors=False):
+    # returns the primary playlist and any mirror playlists saved next to it
+    playlist = find_saved_playlist(output_file) if resume else None
+    if playlist:
+        print(f"Resuming from saved playlist: {playlist}")
+        return playlist, []
+    
+    with metrics.span('capture', title=selected['title'], season=season, episode=episode):
+        m3u8_urls = capture.get_m3u8_url(selected['id'], selected['type'], season, episode, mirrors=use_mirrors)
+    if not m3u8_urls:
+        print("Failed to capture m3u8 URL")
+        return None, []
     
-    searcher = TMDBSearcher()
-    results = searcher.search(query)
+    with metrics.span('playlist', url=m3u8_urls[0]):
+        playlist = capture.download_playlist(m3u8_urls[0], output_file.replace('.ts', '.m3u8'), quality)
+    if not playlist:
+        print("Failed to download playlist")
+        return None, []
     
-    if not results:
-        print("No results found")
+    mirrors = []
+    rendition = capture.rendition
+    if use_mirrors:
+        # other playlists on the primary's host are the player's other
+        # qualities, not mirrors; the rest must offer the rendition the
+        # primary picked (auto is not probed again)
+        host = urlparse(m3u8_urls[0]).netloc
+        k = 0
+        for m3u8_url in m3u8_urls[1:]:
+            if urlparse(m3u8_url).netloc == host:
+                continue
+            k += 1
+            with metrics.span('playlist', url=m3u8_url, mirror=k):
+                mirror = capture.download_playlist(m3u8_url, output_file.replace('.ts', f'.mirror{k}.m3u8'), quality, rendition)
+            if mirror:
+                mirrors.append(mirror)
+    return playlist, mirrors
+
+
+def capture_stage(entries, searcher, capture, ready, resume=False, use_mirrors=False):
+    # producer half of the pipeline: searches each title once and resolves
+    # playlists in order, handing them to the downloader through a bounded
+    # queue so the browser works on the next episode while this one downloads
+    try:
+        for entry in entries:
+            output_file = None
+            try:
+                with metrics.span('search', query=entry['query']):
+                    results = searcher.search(entry['query'])
+                if not results:
+                    print(f"No results found for {entry['query']}")
+                    continue
+                
+                selected = results[0]
+                print(f"Selected: {selected['title']} ({selected['year']})")
+                
+                season = entry['season']
+                episodes = entry['episodes']
+                open_ended = False
+                if selected['type'] != 'tv':
+                    episodes = [None]
+                elif episodes is None:
+                    count = searcher.season_episode_count(selected['id'], season)
+                    # without an episode count, keep going until a capture fails
+                    open_ended = count is None
+                    episodes = itertools.count(1) if open_ended else range(1, count + 1)
+                
+                for episode in episodes:
+                    if entry.get('cancel'):
+                        # a daemon job cancelled while its episodes were captured
+                        break
+                    output_file = title_output_file(selected, season, episode)
+                    playlist, mirrors = prepare_playlist(capture, selected, output_file, entry['quality'], season or 1, episode or 1, entry.get('resume', resume), entry.get('mirrors', use_mirrors))
+                    if playlist is None:
+                        if open_ended:
+                            break
+                        continue
+                    if entry.get('cancel'):
+                        discard_playlists(playlist, mirrors, output_file)
+                        break
+                    ready.put({'playlist': playlist, 'mirrors': mirrors, 'output_file': output_file, 'entry': entry})
+            except Exception as e:
+                # one title that cannot be searched or captured fails on its
+                # own; the titles and daemon jobs behind it still run
+                print(f"✗ Capture failed for {entry['query']}: {e}")
+                entry['error'] = str(e)
+                if output_file:
+                    entry.setdefault('failed', []).append(output_file)
+    finally:
+        ready.put(None)
+
+
+def discard_playlists(playlist, mirrors, output_file):
+    # playlists captured for a job cancelled before it was downloaded; a
+    # partial download keeps its playlist so --resume can still use it
+    if os.path.exists(output_file) or os.path.exists(output_file + '.journal'):
         return
+    for path in [playlist] + list(mirrors):
+        for stale in {path, path.replace('_segments.m3u8', '.m3u8')}:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
+def finish_download(playlist, output_file, mirrors=(), keep_ts=False):
+    paths = [playlist]
+    for mirror in mirrors:
+        # a mirror's master playlist sits next to its variant playlist
+        paths += [mirror, mirror.replace('_segments.m3u8', '.m3u8')]
+    
+    for path in paths:
+        try:
+            os.remove(path)
+        except:
+            pass
+    
+    mp4_output = output_file.replace('.ts', '.mp4')
+    if keep_ts and os.path.exists(mp4_output):
+        # remuxed, with the MPEG-TS stream kept next to it for --repair
+        pass
+    elif os.path.exists(output_file):
+        # remuxing was off or not possible, so the MPEG-TS stream is kept as is
+        os.replace(output_file, mp4_output)
+    print(f"Saved as: {mp4_output}")
+
+
+def prepare_repair(output_file):
+    # the .ts is either a partial download or the stream kept next to a
+    # remuxed MP4; otherwise a finished download has been renamed to .mp4,
+    # and if it is still MPEG-TS it is moved back to be checked and patched
+    if os.path.exists(output_file):
+        return True
+    mp4_output = output_file.replace('.ts', '.mp4')
+    if not os.path.exists(mp4_output):
+        print(f"✗ Nothing to repair: {os.path.basename(output_file)} has not been downloaded")
+        return False
+    with open(mp4_output, 'rb') as f:
+        if f.read(1) != b'\x47':
+            print(f"✗ {os.path.basename(mp4_output)} was remuxed to MP4 without keeping its MPEG-TS stream and cannot be repaired in place")
+            return False
+    os.replace(mp4_output, output_file)
+    return True
+
+
+DAEMON_PORT = 8790
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _JobQueue(queue.Queue):
+    # the capture-to-download queue of a daemon; counts what each job has
+    # handed over so the job is known to be over once capture has moved on
+    # and every download it queued has finished
+    def __init__(self, daemon):
+        super().__init__(maxsize=1)
+        self.daemon = daemon
+
+    def put(self, item, block=True, timeout=None):
+        if item is not None:
+            with self.daemon.lock:
+                item['entry']['pending'] += 1
+        super().put(item, block, timeout)
+
+
+class DownloadDaemon(ThreadingHTTPServer):
+    # a local job queue in front of the download pipeline: jobs come in over
+    # HTTP on localhost and share the warm browser, connection pool and caches
+    # a one-off run would have to set up again
+    daemon_threads = True
+    
+    def __init__(self, port=DAEMON_PORT, quality='720p', options=None):
+        super().__init__(('127.0.0.1', port), _DaemonHandler)
+        self.quality = quality
+        self.options = options or {}
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.incoming = queue.Queue()
+        self.ready = _JobQueue(self)
+        self.lock = threading.Lock()
+    
+    def submit(self, args):
+        query, season, episodes, quality, options = parse_arguments(['-' + self.quality] + list(args))
+        if not query:
+            raise ValueError("no title given")
+        settings = job_settings({**self.options, **options})
+        if settings is None:
+            raise ValueError(f"unknown priority: {options.get('priority')}")
+        job = {
+            'id': next(self.ids),
+            'query': query,
+            'season': season,
+            'episodes': episodes,
+            'quality': quality,
+            'settings': settings,
+            # read by capture_stage in place of its defaults
+            'resume': settings['resume'] or settings['repair'],
+            'mirrors': settings['mirrors'],
+            'state': 'queued',
+            'submitted': time.time(),
+            'finished': None,
+            'current': None,
+            'progress': None,
+            'files': [],
+            'failed': [],
+            'error': None,
+            'captured': False,
+            'pending': 0,
+            'cancel': False,
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+        self.incoming.put(job)
+        return job
     
-    selected = results[0]
-    print(f"Selected: {selected['title']} ({selected['year']})")
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job and job['state'] in ('queued', 'capturing', 'downloading'):
+                # a running download notices at its next finished segment
+                job['cancel'] = True
+                if job['state'] == 'queued':
+                    job['state'] = 'cancelled'
+                    job['finished'] = time.time()
+            return job
     
-    content_type = selected['type']
+    def entries(self):
+        # what capture_stage iterates over; the code after yield runs when
+        # capture moves past the job
+        while True:
+            job = self.incoming.get()
+            if job is None:
+                return
+            with self.lock:
+                if job['cancel']:
+                    continue
+                job['state'] = 'capturing'
+            yield job
+            with self.lock:
+                job['captured'] = True
+                self._settle(job)
     
-    if content_type == 'tv':
-        if season is None or episode is None:
-            print("Season and episode required for TV shows")
+    def _settle(self, job):
+        if not job['captured'] or job['pending'] or job['finished']:
             return
+        if job['cancel']:
+            job['state'] = 'cancelled'
+        elif job['failed'] or not job['files']:
+            job['state'] = 'failed'
+            job['error'] = job['error'] or ('incomplete download' if job['failed'] else 'nothing was found to download')
+        else:
+            job['state'] = 'done'
+        job['finished'] = time.time()
+        job['current'] = None
     
-    safe_title = "".join(c for c in selected['title'] if c.isalnum() or c in (' ', '-', '_')).strip()
-    folder_path = os.path.join(os.getcwd(), safe_title)
-    os.makedirs(folder_path, exist_ok=True)
+    def _progress(self, job, completed, total, nbytes):
+        if job['cancel']:
+            raise JobCancelled()
+        job['progress'] = {'segments': completed, 'total': total, 'bytes': nbytes, 'percent': round(completed * 100 / total, 1) if total else 100.0}
     
-    if content_type == 'tv':
-        output_file = os.path.join(folder_path, f"{safe_title}_S{season:02d}E{episode:02d}.ts")
-    else:
-        output_file = os.path.join(folder_path, f"{safe_title}.ts")
+    def view(self, job):
+        return {name: job[name] for name in ('id', 'query', 'season', 'episodes', 'quality', 'state', 'submitted', 'finished', 'current', 'progress', 'files', 'failed', 'error')}
     
-    capture = VidlinkCapture(headless=True)
-    m3u8_urls = capture.get_m3u8_url(selected['id'], content_type, season, episode, wait_time=10)
+    def serve(self, run):
+        # the HTTP side runs on its own thread; downloads stay on this one, one
+        # at a time, while capture works ahead on the next job
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        print(f"Daemon listening on http://127.0.0.1:{self.server_address[1]}/jobs")
+        try:
+            while True:
+                item = self.ready.get()
+                if item is None:
+                    break
+                job = item['entry']
+                with self.lock:
+                    skip = job['cancel']
+                    if not skip:
+                        job['state'] = 'downloading'
+                        job['current'] = os.path.basename(item['output_file'])
+                        job['progress'] = None
+                
+                success = False
+                if skip:
+                    discard_playlists(item['playlist'], item['mirrors'], item['output_file'])
+                else:
+                    try:
+                        success = run(item, job['settings'], lambda completed, total, nbytes: self._progress(job, completed, total, nbytes))
+                    except JobCancelled:
+                        print(f"\nCancelled: {os.path.basename(item['output_file'])}")
+                    except Exception as e:
+                        # one broken job must not take the daemon down
+                        print(f"\n✗ Job {job['id']} failed: {e}")
+                        job['error'] = str(e)
+                
+                with self.lock:
+                    if success:
+                        job['files'].append(os.path.splitext(item['output_file'])[0] + '.mp4')
+                    elif not skip:
+                        job['failed'].append(item['output_file'])
+                    job['pending'] -= 1
+                    job['current'] = None
+                    self._settle(job)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+            self.server_close()
+
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
     
-    if not m3u8_urls:
-        print("Failed to capture m3u8 URL")
+    def do_GET(self):
+        daemon = self.server
+        path = urlparse(self.path).path.rstrip('/')
+        match = re.fullmatch(r'/jobs/(\d+)', path)
+        if path == '/metrics':
+            self._json(200, metrics.snapshot())
+            return
+        if path == '/trace':
+            self._json(200, metrics.trace())
+            return
+        with daemon.lock:
+            if path == '/jobs':
+                self._json(200, [daemon.view(job) for job in daemon.jobs.values()])
+            elif match and int(match.group(1)) in daemon.jobs:
+                self._json(200, daemon.view(daemon.jobs[int(match.group(1))]))
+            else:
+                self._json(404, {'error': 'no such job'})
+    
+    def do_POST(self):
+        import json
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            self._json(404, {'error': 'not found'})
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            # a page in the browser can POST text/plain to localhost without
+            # a preflight, but not application/json
+            self._json(415, {'error': 'expected application/json'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if 'args' in body:
+                # the command line of a client, as it was typed
+                args = [str(arg) for arg in body['args']]
+            else:
+                args = [str(body.get('query', ''))]
+                if 'season' in body:
+                    args.append(f"-s{int(body['season'])}" + (f"e{int(body['episode'])}" if 'episode' in body else ''))
+                if 'quality' in body:
+                    args.append(f"-{body['quality']}")
+                args += [f"--{name}={value}" if value is not True else f"--{name}" for name, value in body.get('options', {}).items()]
+            job = self.server.submit(args)
+        except (ValueError, TypeError) as e:
+            self._json(400, {'error': str(e)})
+            return
+        with self.server.lock:
+            self._json(201, self.server.view(job))
+    
+    def do_DELETE(self):
+        match = re.fullmatch(r'/jobs/(\d+)', urlparse(self.path).path.rstrip('/'))
+        job = self.server.cancel(int(match.group(1))) if match else None
+        if job is None:
+            self._json(404, {'error': 'no such job'})
+            return
+        with self.server.lock:
+            self._json(200, self.server.view(job))
+    
+    def _json(self, status, data):
+        import json
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def format_job(job):
+    title = job['query']
+    if job['season'] and job['episodes'] != [1]:
+        episodes = job['episodes']
+        title += f" S{job['season']:02d}" + (f"E{episodes[0]:02d}" + (f"-E{episodes[-1]:02d}" if len(episodes) > 1 else '') if episodes else '')
+    line = f"#{job['id']} {job['state']:<11} {title} ({job['quality']})"
+    if job['current']:
+        line += f" | {job['current']}"
+        if job['progress']:
+            line += f" {job['progress']['percent']}%"
+    if job['files']:
+        line += f" | {len(job['files'])} saved"
+    if job['error']:
+        line += f" | {job['error']}"
+    return line
+
+
+def daemon_client(options, args, port=DAEMON_PORT):
+    # the thin client: hands the command line to a running daemon, or asks it
+    # about its jobs
+    url = f"http://127.0.0.1:{port}/jobs"
+    try:
+        if options.get('submit'):
+            response = requests.post(url, json={'args': args}, timeout=10)
+        elif options.get('cancel'):
+            response = requests.delete(f"{url}/{options['cancel']}", timeout=10)
+        else:
+            response = requests.get(url, timeout=10)
+    except requests.exceptions.ConnectionError:
+        print(f"✗ No daemon is listening on port {port}; start one with python main.py --daemon")
         return
     
-    m3u8_url = m3u8_urls[0]
-    playlist = capture.download_playlist(m3u8_url, output_file.replace('.ts', '.m3u8'), quality)
+    data = response.json()
+    if not response.ok:
+        print(f"✗ {data.get('error')}")
+        return
+    for job in data if isinstance(data, list) else [data]:
+        print(format_job(job))
+
+
+def job_settings(options):
+    # the per-download part of the options; a daemon job can override these
+    # without restarting the daemon
+    watch = options.get('watch')
+    if watch is not None:
+        watch = 8800 if watch is True else int(watch)
+    settings = {
+        'resume': bool(options.get('resume', False)),
+        'repair': bool(options.get('repair', False)),
+        'mirrors': bool(options.get('mirrors', False)),
+        'hedge': not options.get('no-hedge'),
+        'remux': not options.get('no-remux'),
+        'validate': not options.get('no-validate'),
+        # the MPEG-TS stream stays next to the MP4 so --repair can patch it
+        'keep_ts': not options.get('no-keep-ts') and not options.get('no-validate'),
+        'max_attempts': int(options.get('attempts', 5)),
+        'watch': watch,
+        'job_rate': parse_rate(options['job-rate']) if options.get('job-rate') else None,
+        # someone watching should not wait behind background grabs
+        'priority': options.get('priority', 'interactive' if watch is not None else 'normal'),
+    }
+    if settings['priority'] not in PRIORITY_WEIGHTS:
+        print(f"✗ Unknown priority: {settings['priority']} (use {', '.join(PRIORITY_WEIGHTS)})")
+        return None
+    return settings
+
+
+def run_job(job, settings, fetcher, engine, max_workers, adaptive=False, bandwidth=None, progress=None):
+    # downloads (or repairs) one captured playlist; True once the file is
+    # complete
+    if settings['repair']:
+        print(f"Repairing: {os.path.basename(job['output_file'])}")
+        if not prepare_repair(job['output_file']):
+            return False
+        with metrics.span('check', file=os.path.basename(job['output_file'])):
+            damaged = check_download(job['playlist'], job['output_file'], max_workers=max_workers)
+        if not damaged:
+            with metrics.span('finish'):
+                finish_download(job['playlist'], job['output_file'], job['mirrors'], settings['remux'] and settings['keep_ts'])
+            return True
     
-    if not playlist:
-        print("Failed to download playlist")
+    print(f"Downloading: {os.path.basename(job['output_file'])}")
+    with metrics.span('download', file=os.path.basename(job['output_file'])) as span:
+        success = download_m3u8_video(
+            job['playlist'], job['output_file'],
+            settings=dict(settings, resume=settings['resume'] or settings['repair'], engine=engine, max_workers=max_workers, adaptive=adaptive),
+            fetcher=fetcher, mirrors=job['mirrors'], bandwidth=bandwidth, progress=progress
+        )
+        span['complete'] = success
+    if success:
+        with metrics.span('finish'):
+            finish_download(job['playlist'], job['output_file'], job['mirrors'], settings['remux'] and settings['keep_ts'])
+    metrics.count('jobs_complete' if success else 'jobs_incomplete')
+    return success
+
+
+def main():
+    query, season, episodes, quality, options = parse_command_line()
+    port = int(options.get('port', DAEMON_PORT))
+    if options.get('submit') or options.get('jobs') or options.get('cancel'):
+        # thin client: the daemon does the work
+        return daemon_client(options, [arg for arg in sys.argv[1:] if not arg.startswith(('--submit', '--port'))], port)
+    
+    engine = options.get('engine', 'thread')
+    adaptive = options.get('adaptive', False)
+    cache_ttl = float(options.get('cache-ttl', 6 * 3600))
+    search_ttl = float(options.get('search-ttl', 7 * 24 * 3600))
+    use_cache = not options.get('no-cache')
+    limit_rate = parse_rate(options['limit-rate']) if options.get('limit-rate') else None
+    settings = job_settings(options)
+    if settings is None:
         return
+    if adaptive:
+        max_workers = int(options.get('workers', 300 if engine == 'async' else 64))
+    else:
+        max_workers = int(options.get('workers', 100 if engine == 'async' else 20))
     
-    success = download_m3u8_video(playlist, output_file)
+    daemon = None
+    if options.get('daemon'):
+        try:
+            daemon = DownloadDaemon(port, quality, options)
+        except OSError as e:
+            print(f"✗ Could not start the daemon on port {port}: {e}")
+            return
+        entries = daemon.entries()
+    elif options.get('batch'):
+        entries = load_batch(options['batch'], quality)
+    elif query:
+        entries = [{'query': query, 'season': season, 'episodes': episodes, 'quality': quality}]
+    else:
+        entries = []
     
+    if not entries:
+        print("Usage: python main.py <title|movie/ID|tv/ID> [-s01e01 | -s01e01-e10 | -s01] [-360p] [--batch=FILE] [--resume] [--engine=thread|async] [--workers=N] [--adaptive] [--attempts=N] [--cache-ttl=SECONDS] [--search-ttl=SECONDS] [--no-cache] [--parser=regex|bs4] [--mirrors] [--no-hedge] [--no-remux] [--no-keep-ts] [--watch[=PORT]] [--limit-rate=RATE] [--job-rate=RATE] [--priority=interactive|normal|background] [--no-validate] [--repair] [-auto [--time-budget=SECONDS]] [--metrics=FILE] [--trace=FILE]")
+        print("       python main.py --daemon [--port=PORT] [--metrics=FILE] [--trace=FILE]")
+        print("       python main.py --submit <title> [options] | --jobs | --cancel=ID [--port=PORT]")
+        return
+    
+    # one engine, and with it one connection pool, serves every job
+    fetcher = create_engine(engine, max_workers, adaptive)
+    if fetcher is None:
+        return
+    
+    # the global cap is shared with other downloads on this host
+    bandwidth = BandwidthScheduler(limit_rate, HostShare(default_cache_path('bandwidth'))) if limit_rate else None
+    
+    ready = daemon.ready if daemon else queue.Queue(maxsize=1)
+    cache = DiskCache(default_cache_path('m3u8_cache.json'), ttl=cache_ttl) if cache_ttl > 0 and use_cache else None
+    search_cache = DiskCache(default_cache_path('search_cache.json'), ttl=search_ttl) if search_ttl > 0 and use_cache else None
+    capture = VidlinkCapture(headless=True, cache=cache, time_budget=float(options.get('time-budget', 1800)))
+    producer = threading.Thread(
+        target=capture_stage,
+        args=(entries, TMDBSearcher(cache=search_cache, parser=options.get('parser', 'regex')), capture, ready, settings['resume'] or settings['repair'], settings['mirrors']),
+        daemon=True
+    )
+    producer.start()
+    
+    if daemon:
+        try:
+            daemon.serve(lambda job, settings, progress: run_job(job, settings, fetcher, engine, max_workers, adaptive, bandwidth, progress))
+        finally:
+            fetcher.close()
+            capture.close()
+            metrics.save(options.get('metrics'), options.get('trace'))
+        return
+    
+    downloaded = []
+    failed = []
     try:
-        os.remove(playlist)
-    except:
-        pass
+        while True:
+            job = ready.get()
+            if job is None:
+                break
+            
+            if run_job(job, settings, fetcher, engine, max_workers, adaptive, bandwidth):
+                downloaded.append(job['output_file'])
+            else:
+                failed.append(job['output_file'])
+    finally:
+        fetcher.close()
+        capture.close()
+        metrics.save(options.get('metrics'), options.get('trace'))
     
-    if success:
-        mp4_output = output_file.replace('.ts', '.mp4')
-        os.rename(output_file, mp4_output)
-        print(f"Saved as: {mp4_output}")
+    if len(downloaded) + len(failed) > 1:
+        print(f"Batch finished: {len(downloaded)} downloaded, {len(failed)} incomplete")
+        for output_file in failed:
+            print(f"  incomplete: {os.path.basename(output_file)}")
+    
+    if failed:
+        # keep the playlists and journals around so --resume can pick up from here
+        print("Run again with --resume to fetch only the missing segments")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()